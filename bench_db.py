@@ -0,0 +1,74 @@
+# bench_db.py
+# Микро-бенчмарк горячих запросов: asyncpg напрямую (DB_FAST_PATH) против SQLAlchemy + databases.
+# Время на вызов (среднее, p50, p95) и CPU процесса на вызов — то, что платит каждый клик.
+# Ничего не меняет: статус/оплату пишем теми же значениями, активация — по несуществующему id,
+# тестовый подписчик удаляется в конце.
+#
+#   python bench_db.py [--n 500]
+import argparse
+import asyncio
+import statistics
+import time
+
+import database as db
+
+_BENCH_USER_ID = -727001   # заведомо не Telegram-id
+
+
+async def _get_meta_uncached():
+    db.invalidate_meta("bench:key")   # меряем запрос, а не LRU
+    return await db.get_meta("bench:key")
+
+
+async def _calls():
+    row = await db.database.fetch_one("SELECT id, status, paid FROM users ORDER BY id LIMIT 1")
+    rid = row["id"] if row else -1
+    status = row["status"] if row else "не активирован"
+    paid = row["paid"] if row else "не оплатил"
+    return [
+        ("get_row", lambda: db.get_row(rid)),
+        ("update_status_by_id", lambda: db.update_status_by_id(rid, status)),
+        ("activate_ticket_by_id", lambda: db.activate_ticket_by_id(-1)),
+        ("set_paid_status_by_id", lambda: db.set_paid_status_by_id(rid, paid)),
+        ("get_meta", _get_meta_uncached),
+        ("has_role", lambda: db.has_role(_BENCH_USER_ID, "admin")),
+        ("add_subscriber", lambda: db.add_subscriber(_BENCH_USER_ID, "bench")),
+    ]
+
+
+async def _bench(fn, n: int):
+    for _ in range(min(n, 20)):   # прогрев: подготовка statement'ов, кэши драйвера
+        await fn()
+    lat = []
+    cpu0 = time.process_time()
+    for _ in range(n):
+        t0 = time.perf_counter()
+        await fn()
+        lat.append((time.perf_counter() - t0) * 1000)
+    cpu_us = (time.process_time() - cpu0) * 1e6 / n
+    lat.sort()
+    return statistics.fmean(lat), lat[len(lat) // 2], lat[int(len(lat) * 0.95)], cpu_us
+
+
+async def main():
+    ap = argparse.ArgumentParser(description="Бенчмарк горячих запросов БД")
+    ap.add_argument("--n", type=int, default=500)
+    args = ap.parse_args()
+
+    await db.connect_db()
+    try:
+        print(f"{'запрос':<24}{'путь':<8}{'ср, мс':>9}{'p50':>8}{'p95':>8}{'CPU, мкс':>11}")
+        for name, fn in await _calls():
+            for label, fast in (("orm", False), ("fast", True)):
+                db.DB_FAST_PATH = fast
+                avg, p50, p95, cpu = await _bench(fn, args.n)
+                print(f"{name:<24}{label:<8}{avg:>9.3f}{p50:>8.3f}{p95:>8.3f}{cpu:>11.1f}")
+    finally:
+        await db.database.execute(
+            "DELETE FROM subscribers WHERE user_id = :uid", {"uid": _BENCH_USER_ID}
+        )
+        await db.disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,44 @@
+# bench_qr.py
+# Микро-бенчмарк профиля рендера QR: байты на билет и время рендера.
+# Сравнивает умолчания qrcode.make (box 10, border 4) с профилем из config (QR_*).
+#
+#   python bench_qr.py [--n 200]
+import argparse
+import time
+from io import BytesIO
+
+import qrcode
+
+from config import QR_ERROR_CORRECTION, QR_BOX_SIZE, QR_BORDER, QR_VERSION
+from qr_generator import make_payload, _render
+
+
+def _render_default(payload: str) -> bytes:
+    buf = BytesIO()
+    qrcode.make(payload).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def _bench(name: str, fn, payloads: list[str]):
+    t0 = time.perf_counter()
+    sizes = [len(fn(p)) for p in payloads]
+    ms = (time.perf_counter() - t0) * 1000 / len(payloads)
+    print(f"{name:<28} {sum(sizes) / len(sizes):>9.0f} B/билет {ms:>8.2f} мс/билет")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Бенчмарк рендера QR")
+    ap.add_argument("--n", type=int, default=200)
+    args = ap.parse_args()
+
+    signed = [make_payload(100000 + i, "bench_event", "single") for i in range(args.n)]
+    numeric = [make_payload(100000 + i) for i in range(args.n)]
+
+    print(f"Профиль: EC={QR_ERROR_CORRECTION} box={QR_BOX_SIZE} border={QR_BORDER} version={QR_VERSION or 'auto'}")
+    for label, payloads in (("подписанный T1", signed), ("числовой row_id", numeric)):
+        _bench(f"default / {label}", _render_default, payloads)
+        _bench(f"profile / {label}", _render, payloads)
+
+
+if __name__ == "__main__":
+    main()
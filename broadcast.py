@@ -0,0 +1,95 @@
+# broadcast.py
+# Движок массовых отправок: ограниченный параллелизм + общий token bucket (rate_limit).
+# TelegramRetryAfter ставит на паузу весь bucket (а не одну задачу) и повторяет отправку.
+#
+#   await tg_call(lambda: bot.send_message(...))   — один вызов API под лимитом
+#   stats = await run(recipients, send)            — send(uid) для каждого получателя
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+
+import config
+import rate_limit
+
+_RETRIES = 3
+
+
+async def tg_call(factory):
+    """
+    Вызов Telegram API под общим лимитом. factory — функция без аргументов, возвращающая корутину
+    (корутину нельзя await-ить повторно, а после RetryAfter запрос нужно повторить).
+    """
+    for attempt in range(_RETRIES + 1):
+        await rate_limit.acquire()
+        try:
+            return await factory()
+        except TelegramRetryAfter as e:
+            rate_limit.pause(e.retry_after)
+            if attempt == _RETRIES:
+                raise
+
+
+async def run(recipients, send, concurrency: int | None = None, progress=None, on_result=None,
+              log: bool = True) -> dict:
+    """
+    Рассылка: send(uid) для каждого uid из recipients (список или async-итератор — читаем по мере
+    отправки, в памяти только очередь). Не больше concurrency отправок одновременно.
+    progress(stats) — необязательный async-колбэк примерно раз в секунду.
+    on_result(uid, outcome) — итог по получателю: "sent" | "blocked" | "failed".
+    Возвращает {"sent", "blocked", "failed", "elapsed_sec", "per_sec"}.
+    """
+    workers = max(concurrency or config.TG_SEND_CONCURRENCY, 1)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+    stats = {"sent": 0, "blocked": 0, "failed": 0}
+    t0 = time.monotonic()
+    last_report = t0
+
+    def _summary() -> dict:
+        elapsed = time.monotonic() - t0
+        done = stats["sent"]
+        return {**stats, "elapsed_sec": round(elapsed, 1), "per_sec": round(done / elapsed, 1) if elapsed else 0.0}
+
+    async def worker():
+        nonlocal last_report
+        while True:
+            uid = await queue.get()
+            if uid is None:
+                return
+            try:
+                await send(uid)
+                outcome = "sent"
+            except TelegramForbiddenError:
+                outcome = "blocked"   # бот заблокирован / пользователь удалён
+            except Exception:
+                outcome = "failed"
+            stats[outcome] += 1
+            if on_result:
+                on_result(uid, outcome)
+            if progress and time.monotonic() - last_report >= 1:
+                last_report = time.monotonic()
+                try:
+                    await progress(_summary())
+                except Exception:
+                    pass
+
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    try:
+        if hasattr(recipients, "__aiter__"):
+            async for uid in recipients:
+                await queue.put(uid)
+        else:
+            for uid in recipients:
+                await queue.put(uid)
+        for _ in tasks:
+            await queue.put(None)
+        await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+
+    result = _summary()
+    if log:
+        print(f"[BROADCAST] sent={result['sent']} blocked={result['blocked']} failed={result['failed']} "
+              f"in {result['elapsed_sec']}s ({result['per_sec']}/s)", flush=True)
+    return result
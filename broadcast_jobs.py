@@ -0,0 +1,242 @@
+# broadcast_jobs.py
+# Рассылки как сохранённые задания (broadcast_jobs): параметры сообщения, курсор по
+# subscribers.user_id и счётчики живут в БД. Исполнитель идёт страницами по BROADCAST_PAGE
+# получателей; во время страницы раз в несколько секунд (и в конце — вместе с курсором)
+# одной транзакцией пишет накопленные итоги (broadcast_deliveries) и продлевает аренду.
+# Аренда помечена токеном исполнителя: забрали её — старый исполнитель прекращает отправку
+# и ничего не пишет. После рестарта/деплоя задание подхватывается с курсора (аренда истекла).
+# Гарантия «хотя бы один раз»: тем, чей итог не успели записать до сбоя (последние несколько
+# секунд отправки), сообщение уйдёт повторно; записанным — нет.
+# Пауза/отмена — статус в БД, исполнитель видит его при очередной записи.
+#
+#   await start(bot, kind, spec, reply_chat_id)  — создать и запустить
+#   run(bot)                                     — фоновый цикл подбора заданий (main.on_startup)
+import asyncio
+import json
+import time
+import uuid
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+import config
+import broadcast
+from database import (
+    create_broadcast_job, claim_broadcast_jobs, get_broadcast_page, save_broadcast_page,
+    renew_broadcast_lease, set_broadcast_progress_msg, get_broadcast_job, prune_broadcast_deliveries,
+)
+
+KIND_COPY_POST = "copy_post"          # spec: {"post_id"}
+KIND_EVENT_NOTICE = "event_notice"    # spec: {"post_id" | None, "event_title"}
+KIND_NEW_EVENT = "new_event"          # spec: {"event_title"}
+
+_STATUS_TITLES = {"running": "идёт", "paused": "на паузе", "cancelled": "отменена", "done": "завершена"}
+
+_FLUSH_SEC = 5   # как часто во время страницы писать итоги и продлевать аренду
+
+_running: dict[int, asyncio.Task] = {}
+_wake = asyncio.Event()
+
+
+def _channel_url() -> str:
+    return f"https://t.me/{(config.CHANNEL_ID or '').lstrip('@')}"
+
+
+def _sender(bot, kind: str, spec: dict):
+    """Функция отправки одному получателю по типу задания."""
+    post_id = spec.get("post_id")
+    title = spec.get("event_title")
+
+    async def copy_post(uid):
+        await broadcast.tg_call(
+            lambda: bot.copy_message(chat_id=uid, from_chat_id=config.CHANNEL_ID, message_id=int(post_id))
+        )
+
+    async def new_event(uid):
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Подписаться на Telegram", url=_channel_url())],
+            [InlineKeyboardButton(text="📷 Подписаться на Instagram", url=config.INSTAGRAM_LINK)],
+            [InlineKeyboardButton(text="🎟 Оплатить билет", callback_data="buy_ticket_menu")],
+        ])
+        await broadcast.tg_call(lambda: bot.send_message(
+            uid, f"🔥 Новое мероприятие: {title}\n\nБилеты уже доступны — не забудь купить👇", reply_markup=kb
+        ))
+
+    async def event_notice(uid):
+        # 1) копируем последний пост (если известен)
+        if post_id:
+            try:
+                await copy_post(uid)
+            except Exception:
+                pass  # игнорируем тех, к кому не доставили
+        # 2) проверяем подписку на канал (тоже вызов API — под общим лимитом)
+        try:
+            member = await broadcast.tg_call(lambda: bot.get_chat_member(config.CHANNEL_ID, uid))
+            subscribed = getattr(member, "status", None) in ("member", "administrator", "creator")
+        except Exception:
+            subscribed = False
+        rows = [] if subscribed else [
+            [InlineKeyboardButton(text="✅ Подписаться на Telegram", url=_channel_url())],
+            [InlineKeyboardButton(text="📷 Подписаться на Instagram", url=config.INSTAGRAM_LINK)],
+        ]
+        rows.append([InlineKeyboardButton(text="🎟 Оплатить билет", callback_data="buy_ticket_menu")])
+        # 3) отправляем уведомление
+        await broadcast.tg_call(lambda: bot.send_message(
+            uid, f"🔥 Новое мероприятие: {title}\n\nБилеты уже доступны — жми ниже 👇",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=rows)
+        ))
+
+    return {KIND_COPY_POST: copy_post, KIND_NEW_EVENT: new_event, KIND_EVENT_NOTICE: event_notice}[kind]
+
+
+def progress_text(job) -> str:
+    done = job["sent"] + job["blocked"] + job["failed"]
+    total = job["total"] or 0
+    return (
+        f"📣 Рассылка #{job['id']} — {_STATUS_TITLES.get(job['status'], job['status'])}\n"
+        f"Обработано: {done}" + (f" из {total}" if total else "") + "\n"
+        f"Доставлено: {job['sent']}, заблокировали бота: {job['blocked']}, ошибок: {job['failed']}"
+    )
+
+
+def job_kb(job) -> InlineKeyboardMarkup | None:
+    jid = job["id"]
+    if job["status"] == "running":
+        row = [InlineKeyboardButton(text="⏸ Пауза", callback_data=f"bj:pause:{jid}")]
+    elif job["status"] == "paused":
+        row = [InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"bj:resume:{jid}")]
+    else:
+        return None
+    row.append(InlineKeyboardButton(text="✖️ Отменить", callback_data=f"bj:cancel:{jid}"))
+    return InlineKeyboardMarkup(inline_keyboard=[row, [
+        InlineKeyboardButton(text="🔄 Обновить", callback_data=f"bj:show:{jid}"),
+    ]])
+
+
+async def _show_progress(bot, job):
+    if not job["reply_chat_id"] or not job["progress_msg_id"]:
+        return
+    try:
+        await broadcast.tg_call(lambda: bot.edit_message_text(
+            progress_text(job), chat_id=job["reply_chat_id"], message_id=job["progress_msg_id"],
+            reply_markup=job_kb(job),
+        ))
+    except Exception:
+        pass   # «message is not modified» и т.п.
+
+
+async def _send_page(job_id: int, token: str, page: list[int], send, cursor: int):
+    """
+    Отправить страницу; пока идёт отправка — периодически пишем накопленные итоги
+    (курсор не двигаем) и тем самым продлеваем аренду. Возвращает строку задания после
+    записи хвоста страницы с новым курсором или None, если аренду забрали.
+    """
+    outcomes: dict[int, str] = {}
+
+    def take() -> dict[int, str]:
+        batch = dict(outcomes)
+        outcomes.clear()
+        return batch
+
+    sending = asyncio.create_task(broadcast.run(page, send, on_result=outcomes.__setitem__, log=False))
+    try:
+        flush_sec = min(_FLUSH_SEC, max(config.BROADCAST_LEASE_SEC / 3, 1))
+        while not (await asyncio.wait({sending}, timeout=flush_sec))[0]:
+            batch = take()
+            if batch:
+                job = await save_broadcast_page(job_id, token, cursor, batch, config.BROADCAST_LEASE_SEC)
+                alive = job is not None and job["status"] == "running"
+            else:
+                alive = await renew_broadcast_lease(job_id, token, config.BROADCAST_LEASE_SEC)
+            if not alive:
+                break   # аренду забрали или задание остановили — прекращаем слать
+        else:
+            sending.result()
+            return await save_broadcast_page(job_id, token, page[-1], take(), config.BROADCAST_LEASE_SEC)
+    finally:
+        sending.cancel()
+    # остановлено посреди страницы: пишем что успели (если аренда ещё наша), курсор не двигаем
+    return await save_broadcast_page(job_id, token, cursor, take(), config.BROADCAST_LEASE_SEC)
+
+
+async def _run_job(bot, job):
+    job_id = job["id"]
+    token = job["lease_token"]
+    send = _sender(bot, job["kind"], json.loads(job["spec"]))
+    cursor = job["cursor"]
+    last_shown = 0.0
+    while True:
+        page = await get_broadcast_page(job_id, cursor, config.BROADCAST_PAGE)
+        if not page:
+            saved = await save_broadcast_page(job_id, token, cursor, {}, config.BROADCAST_LEASE_SEC, done=True)
+        else:
+            saved = await _send_page(job_id, token, page, send, cursor)
+        if saved is None:
+            print(f"[BROADCAST] job #{job_id}: lease taken over, stopping", flush=True)
+            return
+        job = saved
+        if job["status"] != "running" or not page:
+            break
+        cursor = job["cursor"]
+        if time.monotonic() - last_shown >= 3:
+            last_shown = time.monotonic()
+            await _show_progress(bot, job)
+    await _show_progress(bot, job)
+    print(f"[BROADCAST] job #{job_id} {job['status']}: sent={job['sent']} "
+          f"blocked={job['blocked']} failed={job['failed']}", flush=True)
+
+
+def _spawn(bot, job):
+    async def runner():
+        try:
+            await _run_job(bot, job)
+        except Exception as e:
+            # аренда истечёт — задание подберёт следующий цикл
+            print(f"[WARN] broadcast job #{job['id']} failed: {e}", flush=True)
+        finally:
+            if _running.get(job["id"]) is asyncio.current_task():
+                _running.pop(job["id"], None)
+    _running[job["id"]] = asyncio.create_task(runner())
+
+
+async def _claim(bot):
+    for job in await claim_broadcast_jobs(config.BROADCAST_LEASE_SEC, uuid.uuid4().hex):
+        old = _running.get(job["id"])
+        if old:
+            old.cancel()   # наш же исполнитель проспал аренду — его токен больше не действует
+        _spawn(bot, job)
+
+
+async def start(bot, kind: str, spec: dict, reply_chat_id: int | None = None) -> int:
+    """Создать задание рассылки; если задан reply_chat_id — туда сообщение с живым прогрессом."""
+    job_id = await create_broadcast_job(kind, spec, reply_chat_id)
+    if reply_chat_id:
+        job = await get_broadcast_job(job_id)
+        msg = await bot.send_message(reply_chat_id, progress_text(job), reply_markup=job_kb(job))
+        await set_broadcast_progress_msg(job_id, msg.message_id)
+    wake()
+    return job_id
+
+
+def wake():
+    """Подобрать задания сейчас (новое/продолженное), не дожидаясь BROADCAST_CLAIM_SEC."""
+    _wake.set()
+
+
+async def run(bot):
+    """Фоновый цикл: забираем запущенные задания без живой аренды (в т.ч. после рестарта)."""
+    while True:
+        _wake.clear()
+        try:
+            await _claim(bot)
+        except Exception as e:
+            print(f"[WARN] broadcast claim failed: {e}", flush=True)
+        try:
+            n = await prune_broadcast_deliveries()
+            if n:
+                print(f"[BROADCAST] pruned {n} delivery records of finished jobs", flush=True)
+        except Exception as e:
+            print(f"[WARN] broadcast deliveries prune failed: {e}", flush=True)
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=config.BROADCAST_CLAIM_SEC)
+        except asyncio.TimeoutError:
+            pass
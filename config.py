@@ -12,17 +12,76 @@ SCAN_WEBAPP_URL = os.getenv("SCAN_WEBAPP_URL")
 def _parse_ids(s: str):
     return [int(x) for x in (s or "").replace(" ", "").split(",") if x]
 
+# Пакетный эндпоинт сканера: срок жизни initData WebApp и максимум кодов за запрос
+SCAN_AUTH_MAX_AGE = int(os.getenv("SCAN_AUTH_MAX_AGE", "86400"))
+SCAN_BATCH_MAX = int(os.getenv("SCAN_BATCH_MAX", "200"))
+
 ADMIN_IDS = _parse_ids(os.getenv("ADMIN_IDS"))
 SCANNER_ADMIN_IDS = _parse_ids(os.getenv("SCANNER_ADMIN_IDS"))
 
 PAYMENTS_ADMIN_ID = int(os.getenv("PAYMENTS_ADMIN_ID", "0")) or None
 PAYMENT_LINK = os.getenv("PAYMENT_LINK")
 POSTGRES_URL = os.getenv("POSTGRES_URL")
+# Пул соединений к БД: сколько держать открытыми с самого старта и максимум
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# Сколько ждать свободное соединение из пула (сек, 0 — без ограничения)
+# и предельное время одного запроса на сервере (мс, 0 — без ограничения)
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "30000"))
+# Горячие запросы — напрямую через asyncpg (подготовленные statement'ы), 0 — через SQLAlchemy
+DB_FAST_PATH = os.getenv("DB_FAST_PATH", "1") == "1"
+# Применять миграции схемы (migrations.py) при старте бота
+RUN_MIGRATIONS_ON_STARTUP = os.getenv("RUN_MIGRATIONS_ON_STARTUP", "1") == "1"
+# Кэш bot_meta: размер и TTL (сек) для обычных и глобальных ключей (цены, промокоды)
+META_CACHE_SIZE = int(os.getenv("META_CACHE_SIZE", "4096"))
+META_CACHE_TTL = int(os.getenv("META_CACHE_TTL", "300"))
+META_CACHE_TTL_GLOBAL = int(os.getenv("META_CACHE_TTL_GLOBAL", "43200"))
+# Как часто перечитывать роли из БД (изменения в обход бота), сек
+ROLES_RELOAD_SEC = int(os.getenv("ROLES_RELOAD_SEC", "300"))
+# Исходящие сообщения в Telegram: токенов в секунду, запас на всплеск, параллельных отправок
+TG_SEND_RATE = float(os.getenv("TG_SEND_RATE", "25"))
+TG_SEND_BURST = int(os.getenv("TG_SEND_BURST", "25"))
+TG_SEND_CONCURRENCY = int(os.getenv("TG_SEND_CONCURRENCY", "10"))
+# Задания рассылок: получателей на страницу (фиксация курсора), аренда исполнителем (сек),
+# как часто подбирать брошенные/возобновлённые задания (сек)
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", "50"))
+BROADCAST_LEASE_SEC = int(os.getenv("BROADCAST_LEASE_SEC", "120"))
+BROADCAST_CLAIM_SEC = int(os.getenv("BROADCAST_CLAIM_SEC", "30"))
+# Окно оплаты (сек) и как долго максимум спит планировщик истечений между проверками
+# (ловит дедлайны, выставленные другими инстансами)
+PAYMENT_TIMEOUT_SEC = int(os.getenv("PAYMENT_TIMEOUT_SEC", "300"))
+PAYMENT_EXPIRY_MAX_SLEEP = float(os.getenv("PAYMENT_EXPIRY_MAX_SLEEP", "30"))
+# Брошенные черновики покупок: старше скольких часов удалять и как часто проверять (сек, 0 — никогда)
+DRAFT_TTL_HOURS = int(os.getenv("DRAFT_TTL_HOURS", "24"))
+DRAFT_COMPACT_SEC = int(os.getenv("DRAFT_COMPACT_SEC", "3600"))
+# Как часто сверять ticket_counters с users, сек (0 — не сверять)
+COUNTERS_RECONCILE_SEC = int(os.getenv("COUNTERS_RECONCILE_SEC", "21600"))
 _raw_promocodes = os.getenv("PROMOCODES", "")
 PROMOCODES = [c.strip().upper() for c in _raw_promocodes.split(",") if c.strip()]
 EVENT_CODE = os.getenv("EVENT_CODE", "default_event")
 EVENT_TITLE = os.getenv("EVENT_TITLE", EVENT_CODE)
 
+# Секрет для подписи QR-билетов (по умолчанию — токен бота)
+QR_SECRET = os.getenv("QR_SECRET") or BOT_TOKEN
+
+# Кэш PNG QR-кодов: сколько держать в памяти и куда сбрасывать на диск ("" — не сбрасывать)
+QR_CACHE_SIZE = int(os.getenv("QR_CACHE_SIZE", "512"))
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR", "qrs")
+
+# Профиль рендера QR: коррекция ошибок (L/M/Q/H), размер модуля в px, рамка в модулях,
+# фиксированная версия QR (пусто — подбирать по длине payload)
+QR_ERROR_CORRECTION = os.getenv("QR_ERROR_CORRECTION", "M").strip().upper()
+QR_BOX_SIZE = int(os.getenv("QR_BOX_SIZE", "8"))
+QR_BORDER = int(os.getenv("QR_BORDER", "4"))
+QR_VERSION = int(os.getenv("QR_VERSION", "0")) or None
+
+# Рендер QR вне event loop: "thread" | "process", число воркеров и длина очереди
+# (сверх очереди интерактивные запросы сразу получают отказ — QrRenderBusy)
+QR_RENDER_MODE = os.getenv("QR_RENDER_MODE", "thread")
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "2"))
+QR_RENDER_QUEUE = int(os.getenv("QR_RENDER_QUEUE", "32"))
+
 # Пароль на смену события (можно тот же, что и для очистки БД)
 ADMIN_EVENT_PASSWORD = os.getenv("ADMIN_EVENT_PASSWORD", "12345")
 
@@ -1,14 +1,36 @@
 # database.py
+import asyncio
+import bisect
+import contextvars
+import functools
+import inspect
+import json
+import time
+from collections import OrderedDict
 from sqlalchemy import (
-    Column, String, MetaData, Table, create_engine,
+    Column, String, MetaData, Table,
     BigInteger, Integer, Date, select, desc, text, DateTime 
 )
 from databases import Database
 from sqlalchemy.sql import func
-from config import POSTGRES_URL
+from config import (
+    ADMIN_IDS, SCANNER_ADMIN_IDS,
+    POSTGRES_URL, DB_POOL_MIN, DB_POOL_MAX, DB_ACQUIRE_TIMEOUT, DB_STATEMENT_TIMEOUT_MS, DB_FAST_PATH,
+)
+from config import META_CACHE_SIZE, META_CACHE_TTL, META_CACHE_TTL_GLOBAL
 
 # --- Подключение ---
-engine = create_engine(POSTGRES_URL.replace("+asyncpg", ""))
+# Синхронный движок (psycopg2) нужен только миграциям — создаём его по первому требованию,
+# чтобы импорт модуля не тянул второй драйвер и не замедлял холодный старт бота.
+_sync_engine = None
+
+def get_sync_engine():
+    global _sync_engine
+    if _sync_engine is None:
+        from sqlalchemy import create_engine
+        _sync_engine = create_engine(POSTGRES_URL.replace("+asyncpg", ""))
+    return _sync_engine
+
 metadata = MetaData()
 
 # --- Таблица покупок (исторически называется "users") ---
@@ -23,7 +45,10 @@ users = Table(
     Column("ticket_type", String),                                  # тип билета
     Column("paid", String, default="не оплатил"),                   # не оплатил | на проверке | оплатил | отклонено
     Column("status", String, default="не активирован"),             # не активирован | активирован
-    Column("purchase_date", Date, server_default=text("CURRENT_DATE"))  # дата покупки (без времени)
+    Column("purchase_date", Date, server_default=text("CURRENT_DATE")),  # дата покупки (без времени)
+    Column("created_at", DateTime(timezone=True), server_default=func.now()),  # для чистки черновиков
+    Column("pay_deadline", DateTime(timezone=True)),   # когда истекает окно оплаты (NULL — таймера нет)
+    Column("pay_msg_id", BigInteger),                  # экран оплаты, с которого снять кнопки по истечении
 )
 
 # --- Таблица попыток купить 1+1 при закрытом лимите ---
@@ -37,6 +62,26 @@ one_plus_one_attempts = Table(
     Column("attempted_at", DateTime(timezone=True), server_default=func.now(), nullable=False),
 )
 
+# --- Старые QR (user_id) -> конкретная покупка (row_id) ---
+# Заполняется один раз миграцией (см. LEGACY_QR_MAP_BUILD_SQL / init_db.py).
+legacy_qr_map = Table(
+    "legacy_qr_map",
+    metadata,
+    Column("user_id", BigInteger, primary_key=True),
+    Column("row_id", Integer, nullable=False),
+)
+
+# Одноразовое заполнение: последняя покупка каждого пользователя на момент миграции.
+# Повторный запуск ничего не делает, если таблица уже заполнена.
+LEGACY_QR_MAP_BUILD_SQL = """
+    INSERT INTO legacy_qr_map(user_id, row_id)
+    SELECT DISTINCT ON (user_id) user_id, id
+    FROM users
+    WHERE NOT EXISTS (SELECT 1 FROM legacy_qr_map)
+    ORDER BY user_id, id DESC
+    ON CONFLICT (user_id) DO NOTHING
+"""
+
 # --- Роли пользователей (админ/сканер/оплаты) ---
 roles = Table(
     "roles",
@@ -88,6 +133,55 @@ bot_meta = Table(
 )
 
 
+# --- Цены билетов по мероприятиям (для подсчёта выручки в SQL) ---
+# Дублирует JSON в bot_meta "prices:<event>", который читает пользовательский поток.
+event_prices = Table(
+    "event_prices",
+    metadata,
+    Column("event_code", String, primary_key=True),
+    Column("ticket_type", String, primary_key=True),   # 1+1 | single | promocode
+    Column("price", Integer, nullable=False),
+)
+
+# Перенос уже сохранённых цен из bot_meta (JSON) в event_prices
+EVENT_PRICES_BACKFILL_SQL = """
+    INSERT INTO event_prices(event_code, ticket_type, price)
+    SELECT substr(m.key, length('prices:') + 1), p.key, p.value::int
+    FROM bot_meta m
+    CROSS JOIN LATERAL jsonb_each_text(
+        CASE WHEN m.value ~ '^\\s*\\{' THEN m.value::jsonb ELSE '{}'::jsonb END
+    ) AS p(key, value)
+    WHERE m.key LIKE 'prices:%'
+      AND p.value ~ '^\\d+$'
+    ON CONFLICT (event_code, ticket_type) DO NOTHING
+"""
+
+# --- Счётчики продаж (инкрементальные) ---
+# Одна строка на (мероприятие, тип билета, статус оплаты): сколько покупок.
+# Поддерживается триггером на users (в той же транзакции, что и изменение paid),
+# пересобирается rebuild_ticket_counters(). Активации сюда не пишем: иначе каждый
+# проход на входе ждал бы блокировку одной строки счётчика — их считаем по users
+# через частичный индекс ix_users_activated (см. get_report_counters).
+# NULL в ключах хранится как '—' (как в get_ticket_stats_*).
+ticket_counters = Table(
+    "ticket_counters",
+    metadata,
+    Column("event_code", String, primary_key=True),
+    Column("ticket_type", String, primary_key=True),
+    Column("paid", String, primary_key=True),
+    Column("qty", Integer, nullable=False, server_default=text("0")),
+)
+
+TICKET_COUNTERS_REBUILD_SQL = """
+    INSERT INTO ticket_counters(event_code, ticket_type, paid, qty)
+    SELECT COALESCE(event_code, '—'),
+           COALESCE(ticket_type, '—'),
+           COALESCE(paid, '—'),
+           COUNT(*)
+    FROM users
+    GROUP BY 1, 2, 3
+"""
+
 # --- Лимиты 1+1 по мероприятиям ---
 one_plus_one_limits = Table(
     "one_plus_one_limits",
@@ -100,15 +194,198 @@ one_plus_one_limits = Table(
            nullable=False),
 )
 
-database = Database(POSTGRES_URL)
+# --- Рассылки как задания: курсор по subscribers.user_id, счётчики, аренда исполнителем ---
+broadcast_jobs = Table(
+    "broadcast_jobs",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("kind", String, nullable=False),              # copy_post | event_notice | new_event
+    Column("spec", String, nullable=False),              # JSON параметров сообщения
+    Column("status", String, nullable=False, server_default="running"),  # running | paused | cancelled | done
+    Column("cursor", BigInteger, nullable=False, server_default="0"),    # последний обработанный user_id
+    Column("sent", Integer, nullable=False, server_default="0"),
+    Column("blocked", Integer, nullable=False, server_default="0"),
+    Column("failed", Integer, nullable=False, server_default="0"),
+    Column("total", Integer),                             # подписчиков на момент старта
+    Column("reply_chat_id", BigInteger),                  # куда показывать прогресс
+    Column("progress_msg_id", BigInteger),
+    Column("locked_until", DateTime(timezone=True)),      # аренда: кто-то уже исполняет
+    Column("lease_token", String),                        # чья аренда: записи без него отбрасываются
+    Column("created_at", DateTime(timezone=True), server_default=func.now(), nullable=False),
+    Column("updated_at", DateTime(timezone=True), server_default=func.now(), nullable=False),
+)
+
+# Итог по каждому получателю — повторный проход после сбоя не шлёт тем, чей итог записан.
+# У завершённых/отменённых заданий чистится prune_broadcast_deliveries().
+broadcast_deliveries = Table(
+    "broadcast_deliveries",
+    metadata,
+    Column("job_id", Integer, primary_key=True),
+    Column("user_id", BigInteger, primary_key=True),
+    Column("outcome", String, nullable=False),            # sent | blocked | failed
+)
+
+# Пул asyncpg с явными границами: min_size соединений открываются сразу при connect().
+# statement_timeout — на стороне сервера, для каждой сессии пула (0 — без ограничения).
+database = Database(
+    POSTGRES_URL, min_size=DB_POOL_MIN, max_size=DB_POOL_MAX,
+    server_settings={"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)},
+)
+
+# =============================================================================
+# Метрики пула и запросов (для /diag): ожидание соединения, занятые/свободные,
+# гистограммы времени по каждой публичной async-функции модуля (обёртка — в конце файла)
+# =============================================================================
+_LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+def _new_hist() -> dict:
+    return {"count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+            "buckets": [0] * (len(_LATENCY_BUCKETS_MS) + 1), "cached": 0}
+
+def _observe(hist: dict, ms: float, error: bool = False):
+    hist["count"] += 1
+    hist["errors"] += error
+    hist["total_ms"] += ms
+    hist["max_ms"] = max(hist["max_ms"], ms)
+    hist["buckets"][bisect.bisect_left(_LATENCY_BUCKETS_MS, ms)] += 1
+
+_acquire_hist = _new_hist()
+_query_hists: dict[str, dict] = {}
+_acquire_waiting = 0
+# вызов ответил из памяти (кэш bot_meta, таблица ролей) — в гистограмму запросов не пишем
+_served_from_memory = contextvars.ContextVar("_served_from_memory", default=False)
+
+def _mark_cached():
+    _served_from_memory.set(True)
+
+class _TimedPool:
+    """
+    Обёртка над asyncpg.Pool: databases берёт соединение через pool.acquire() без таймаута —
+    здесь добавляем DB_ACQUIRE_TIMEOUT и замер ожидания; остальное отдаём пулу как есть.
+    """
+    def __init__(self, pool):
+        self._pool = pool
+
+    async def acquire(self, *, timeout=None):
+        global _acquire_waiting
+        _acquire_waiting += 1
+        t0 = time.perf_counter()
+        failed = True
+        try:
+            conn = await self._pool.acquire(timeout=timeout or DB_ACQUIRE_TIMEOUT or None)
+            failed = False
+            return conn
+        finally:
+            _acquire_waiting -= 1
+            _observe(_acquire_hist, (time.perf_counter() - t0) * 1000, failed)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+def _instrument_pool():
+    backend = database._backend
+    if backend._pool is not None and not isinstance(backend._pool, _TimedPool):
+        backend._pool = _TimedPool(backend._pool)
+
+def _timed(fn):
+    hist = _query_hists.setdefault(fn.__name__, _new_hist())
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        token = _served_from_memory.set(False)
+        t0 = time.perf_counter()
+        failed = True
+        try:
+            result = await fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            if _served_from_memory.get() and not failed:
+                hist["cached"] += 1
+            else:
+                _observe(hist, (time.perf_counter() - t0) * 1000, failed)
+            _served_from_memory.reset(token)
+    return wrapper
+
+def _hist_summary(hist: dict) -> dict:
+    n = hist["count"]
+    return {
+        "count": n,
+        "cached": hist["cached"],
+        "errors": hist["errors"],
+        "avg_ms": round(hist["total_ms"] / n, 2) if n else None,
+        "max_ms": round(hist["max_ms"], 2),
+        "buckets_ms": dict(zip([f"<={b}" for b in _LATENCY_BUCKETS_MS] + ["inf"], hist["buckets"])),
+    }
+
+def db_stats() -> dict:
+    """Метрики для /diag: размер пула, занятые/свободные соединения, ожидание и запросы."""
+    pool = getattr(database._backend, "_pool", None)
+    size = pool.get_size() if pool else 0
+    idle = pool.get_idle_size() if pool else 0
+    return {
+        "pool": {
+            "min": DB_POOL_MIN,
+            "max": DB_POOL_MAX,
+            "size": size,
+            "active": size - idle,
+            "idle": idle,
+            "waiting": _acquire_waiting,
+        },
+        "acquire": _hist_summary(_acquire_hist),
+        "queries": {
+            name: _hist_summary(h)
+            for name, h in sorted(_query_hists.items(), key=lambda kv: -kv[1]["total_ms"])
+            if h["count"] or h["cached"]
+        },
+    }
 
 # --- Базовые подключения ---
 async def connect_db():
     await database.connect()
+    _instrument_pool()
+    # Прогрев: по запросу на каждое стартовое соединение (параллельно — разные соединения),
+    # чтобы первый апдейт не платил за установку сессии и интроспекцию типов
+    await asyncio.gather(*(database.fetch_val("SELECT 1") for _ in range(max(DB_POOL_MIN, 1))))
 
 async def disconnect_db():
     await database.disconnect()
 
+# =============================================================================
+# Быстрый путь для горячих запросов: asyncpg напрямую, без компиляции SQLAlchemy
+# и обёрток databases. Текст запроса постоянный — asyncpg держит его подготовленным
+# в кэше statement'ов каждого соединения. Соединение берём через database.connection(),
+# поэтому внутри транзакции запрос идёт в то же соединение. DB_FAST_PATH=0 — старый путь.
+# =============================================================================
+_USERS_COLS = ", ".join(c.name for c in users.c)
+_FAST_SQL = {
+    "get_row": f"SELECT {_USERS_COLS} FROM users WHERE id = $1",
+    "update_status": "UPDATE users SET status = $2 WHERE id = $1",
+    "activate": (
+        "UPDATE users SET status = 'активирован' "
+        "WHERE id = $1 AND status = 'не активирован' RETURNING id"
+    ),
+    "set_paid": "UPDATE users SET paid = $2, pay_deadline = NULL, pay_msg_id = NULL WHERE id = $1",
+    "get_meta": "SELECT value FROM bot_meta WHERE key = $1",
+    "has_role": "SELECT 1 FROM roles WHERE user_id = $1 AND role = $2 LIMIT 1",
+    "add_subscriber": (
+        "INSERT INTO subscribers(user_id, username, last_seen_at) VALUES ($1, $2, NOW()) "
+        "ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username, last_seen_at = NOW()"
+    ),
+}
+
+async def _fast_fetchrow(name: str, *args):
+    async with database.connection() as conn:
+        return await conn.raw_connection.fetchrow(_FAST_SQL[name], *args)
+
+async def _fast_fetchval(name: str, *args):
+    async with database.connection() as conn:
+        return await conn.raw_connection.fetchval(_FAST_SQL[name], *args)
+
+async def _fast_execute(name: str, *args):
+    async with database.connection() as conn:
+        await conn.raw_connection.execute(_FAST_SQL[name], *args)
+
 # =============================================================================
 # Новые функции: работаем с КОНКРЕТНОЙ записью (id строки = "row_id")
 # =============================================================================
@@ -130,8 +407,131 @@ async def add_user(user_id: int, username: str, event_code: str, ticket_type: st
     row_id = await database.fetch_val(query)
     return int(row_id)
 
+async def claim_draft_row(user_id: int, username: str, event_code: str, ticket_type: str) -> tuple[int, int | None]:
+    """
+    Черновик покупки для экрана оплаты одним запросом: берём последний незавершённый
+    (не оплатил / в процессе оплаты) билет пользователя на это мероприятие и проставляем
+    тип, иначе создаём новую строку. Статус — «в процессе оплаты».
+    Параллельные «купить» одного пользователя выстраиваем в очередь (advisory-lock на user_id),
+    иначе оба не нашли бы черновик и создали по строке.
+    Возвращает (row_id, id прежнего экрана оплаты этого черновика или None) — с прежнего
+    экрана вызывающий снимает кнопки.
+    """
+    q = """
+        WITH prev AS (
+            SELECT id, pay_msg_id
+              FROM users
+             WHERE user_id = :uid AND event_code = :e
+               AND paid IN ('не оплатил', 'в процессе оплаты')
+               AND status = 'не активирован'
+             ORDER BY id DESC
+             LIMIT 1
+        ),
+        reuse AS (
+            UPDATE users u
+               SET ticket_type = :t, username = :u, paid = 'в процессе оплаты', pay_msg_id = NULL,
+                   created_at = NOW()
+              FROM prev
+             WHERE u.id = prev.id
+            RETURNING u.id, prev.pay_msg_id AS old_msg_id
+        ),
+        ins AS (
+            INSERT INTO users(user_id, username, event_code, ticket_type, paid, status)
+            SELECT :uid, :u, :e, :t, 'в процессе оплаты', 'не активирован'
+             WHERE NOT EXISTS (SELECT 1 FROM prev)
+            RETURNING id, CAST(NULL AS BIGINT) AS old_msg_id
+        )
+        SELECT id, old_msg_id FROM reuse
+        UNION ALL
+        SELECT id, old_msg_id FROM ins
+    """
+    async with database.transaction():
+        await database.execute("SELECT pg_advisory_xact_lock(CAST(:uid AS BIGINT))", {"uid": user_id})
+        row = await database.fetch_one(
+            q, {"uid": user_id, "u": username or "Без ника", "e": event_code, "t": ticket_type}
+        )
+    return int(row["id"]), row["old_msg_id"]
+
+# ---- Таймеры оплаты: дедлайн хранится в строке покупки (переживает рестарт) ----
+async def set_payment_deadline(row_id: int, timeout_sec: int, message_id: int | None):
+    await database.execute(
+        """
+        UPDATE users
+           SET pay_deadline = NOW() + make_interval(secs => CAST(:s AS INT)),
+               pay_msg_id = :m
+         WHERE id = :rid
+        """,
+        {"rid": row_id, "s": timeout_sec, "m": message_id},
+    )
+
+async def seconds_to_next_payment_deadline() -> float | None:
+    """Сколько секунд до ближайшего дедлайна оплаты (<= 0 — уже пора), None — таймеров нет."""
+    v = await database.fetch_val(
+        "SELECT EXTRACT(EPOCH FROM MIN(pay_deadline) - NOW()) FROM users WHERE pay_deadline IS NOT NULL"
+    )
+    return float(v) if v is not None else None
+
+async def expire_due_payments(batch: int = 500):
+    """
+    Снимает все наступившие дедлайны одним UPDATE ... RETURNING.
+    «в процессе оплаты» и «отклонено» откатываются в «не оплатил», прочие статусы
+    (на проверке, оплатил) не трогаем — только гасим таймер.
+    SKIP LOCKED — несколько инстансов не обработают одну строку дважды.
+    Возвращает строки: id, user_id, event_code, ticket_type, pay_msg_id, old_paid.
+    """
+    q = """
+        WITH due AS (
+            SELECT id, paid AS old_paid, pay_msg_id
+              FROM users
+             WHERE pay_deadline <= NOW()
+             ORDER BY pay_deadline
+             LIMIT :n
+             FOR UPDATE SKIP LOCKED
+        )
+        UPDATE users u
+           SET paid = CASE WHEN due.old_paid IN ('в процессе оплаты', 'отклонено')
+                           THEN 'не оплатил' ELSE u.paid END,
+               pay_deadline = NULL,
+               pay_msg_id = NULL
+          FROM due
+         WHERE u.id = due.id
+        RETURNING u.id, u.user_id, u.event_code, u.ticket_type, due.pay_msg_id, due.old_paid
+    """
+    return await database.fetch_all(q, {"n": batch})
+
+async def compact_abandoned_drafts(older_than_hours: int, batch: int = 5000) -> int:
+    """
+    Удаляет брошенные черновики (не оплатил / в процессе оплаты, не активирован) старше
+    older_than_hours. Порциями, чтобы не держать длинных блокировок. Возвращает число удалённых.
+    Старые строки без created_at считаем по purchase_date. Строки с живым таймером оплаты
+    не трогаем; выбранные строки блокируем (SKIP LOCKED), чтобы между выборкой и удалением
+    их не успели перевести, например, в «на проверке».
+    """
+    q = """
+        DELETE FROM users
+         WHERE id IN (
+            SELECT id FROM users
+             WHERE paid IN ('не оплатил', 'в процессе оплаты')
+               AND status = 'не активирован'
+               AND pay_deadline IS NULL
+               AND COALESCE(created_at, purchase_date::timestamptz)
+                   < NOW() - make_interval(hours => CAST(:h AS INT))
+             LIMIT :n
+             FOR UPDATE SKIP LOCKED
+         )
+        RETURNING id
+    """
+    total = 0
+    while True:
+        rows = await database.fetch_all(q, {"h": older_than_hours, "n": batch})
+        total += len(rows)
+        if len(rows) < batch:
+            return total
+
 async def get_row(row_id: int):
     """Вернуть полную запись по id строки (или None)."""
+    if DB_FAST_PATH:
+        return await _fast_fetchrow("get_row", row_id)
     query = select(users).where(users.c.id == row_id)
     return await database.fetch_one(query)
 
@@ -141,33 +541,222 @@ async def get_status_by_id(row_id: int):
     return r["status"] if r else None
 
 async def update_status_by_id(row_id: int, status: str):
+    if DB_FAST_PATH:
+        return await _fast_execute("update_status", row_id, status)
     await database.execute(users.update().where(users.c.id == row_id).values(status=status))
 
+# ---- Проход на входе (атомарная активация) ----
+CHECKIN_ACTIVATED = "activated"        # билет активирован этим сканом
+CHECKIN_ALREADY_USED = "already_used"  # билет уже был активирован раньше
+CHECKIN_NOT_FOUND = "not_found"        # такого билета нет
+
+async def checkin_ticket(candidate: int, legacy: bool = True):
+    """
+    Атомарно активирует билет за один запрос к БД.
+    candidate — число из QR. Сначала ищем row_id (дешёвый поиск по PK); при legacy=True
+    и отсутствии такой строки — старый QR через legacy_qr_map (user_id -> row_id).
+    Подписанные QR передают legacy=False — только row_id.
+    Условный UPDATE ... RETURNING исключает двойной проход при одновременных сканах.
+    Возвращает (CHECKIN_*, row) — row содержит id и ticket_type (или None).
+    """
+    if legacy:
+        target_id = """COALESCE(
+                (SELECT id FROM users WHERE id = CAST(:c AS BIGINT)),
+                (SELECT row_id FROM legacy_qr_map WHERE user_id = CAST(:c AS BIGINT))
+            )"""
+    else:
+        target_id = "CAST(:c AS BIGINT)"
+    q = f"""
+        WITH target AS (
+            SELECT id, ticket_type
+            FROM users
+            WHERE id = {target_id}
+        ),
+        upd AS (
+            UPDATE users u
+               SET status = 'активирован'
+              FROM target
+             WHERE u.id = target.id
+               AND u.status = 'не активирован'
+            RETURNING u.id
+        )
+        SELECT target.id,
+               target.ticket_type,
+               EXISTS (SELECT 1 FROM upd) AS activated
+        FROM target
+    """
+    row = await database.fetch_one(q, {"c": candidate})
+    if row is None:
+        return CHECKIN_NOT_FOUND, None
+    if row["activated"]:
+        return CHECKIN_ACTIVATED, row
+    return CHECKIN_ALREADY_USED, row
+
+async def activate_ticket_by_id(row_id: int) -> bool:
+    """
+    Условная активация по row_id: True — активировали именно мы,
+    False — билет уже активирован (или не существует).
+    """
+    if DB_FAST_PATH:
+        return await _fast_fetchval("activate", row_id) is not None
+    q = """
+        UPDATE users
+           SET status = 'активирован'
+         WHERE id = :rid AND status = 'не активирован'
+        RETURNING id
+    """
+    return await database.fetch_val(q, {"rid": row_id}) is not None
+
+async def activate_tickets_by_ids(row_ids: list[int]) -> set[int]:
+    """Пакетная условная активация по row_id. Возвращает id, активированные этим запросом."""
+    if not row_ids:
+        return set()
+    q = """
+        UPDATE users
+           SET status = 'активирован'
+         WHERE id = ANY(CAST(:ids AS BIGINT[])) AND status = 'не активирован'
+        RETURNING id
+    """
+    rows = await database.fetch_all(q, {"ids": list(row_ids)})
+    return {int(r["id"]) for r in rows}
+
+async def checkin_tickets_batch(items: list[tuple[int, bool]]):
+    """
+    Пакетный проход одним запросом. items — [(candidate, legacy), ...] в порядке сканов;
+    legacy как в checkin_ticket. Если один билет встречается в пакете несколько раз,
+    активирует его только первый скан.
+    Возвращает список (CHECKIN_*, row) в том же порядке.
+    """
+    if not items:
+        return []
+    q = """
+        WITH req AS (
+            SELECT r.c, r.legacy, r.ord
+            FROM unnest(CAST(:nums AS BIGINT[]), CAST(:legacy AS BOOLEAN[]))
+                 WITH ORDINALITY AS r(c, legacy, ord)
+        ),
+        target AS (
+            SELECT req.ord, u.id
+            FROM req
+            LEFT JOIN users u ON u.id = COALESCE(
+                (SELECT id FROM users WHERE id = req.c),
+                CASE WHEN req.legacy
+                     THEN (SELECT row_id FROM legacy_qr_map WHERE user_id = req.c)
+                END
+            )
+        ),
+        upd AS (
+            UPDATE users u
+               SET status = 'активирован'
+              FROM (SELECT DISTINCT id FROM target WHERE id IS NOT NULL) t
+             WHERE u.id = t.id
+               AND u.status = 'не активирован'
+            RETURNING u.id
+        )
+        SELECT target.ord,
+               target.id,
+               users.ticket_type,
+               (target.id IN (SELECT id FROM upd)
+                AND ROW_NUMBER() OVER (PARTITION BY target.id ORDER BY target.ord) = 1) AS activated
+        FROM target
+        LEFT JOIN users ON users.id = target.id
+        ORDER BY target.ord
+    """
+    rows = await database.fetch_all(q, {
+        "nums": [int(c) for c, _ in items],
+        "legacy": [bool(l) for _, l in items],
+    })
+    out = []
+    for r in rows:
+        if r["id"] is None:
+            out.append((CHECKIN_NOT_FOUND, None))
+        elif r["activated"]:
+            out.append((CHECKIN_ACTIVATED, r))
+        else:
+            out.append((CHECKIN_ALREADY_USED, r))
+    return out
+
+async def get_event_tickets(event_code: str):
+    """Все оплаченные билеты мероприятия: id, user_id, ticket_type, status (для индекса прохода)."""
+    q = """
+        SELECT id, user_id, ticket_type, status
+        FROM users
+        WHERE event_code = :e AND paid = 'оплатил'
+        ORDER BY id
+    """
+    return await database.fetch_all(q, {"e": event_code})
+
+async def get_legacy_qr_map_for_event(event_code: str):
+    """Старые QR (user_id -> row_id), указывающие на оплаченные билеты мероприятия."""
+    q = """
+        SELECT m.user_id, m.row_id
+        FROM legacy_qr_map m
+        JOIN users u ON u.id = m.row_id
+        WHERE u.event_code = :e AND u.paid = 'оплатил'
+    """
+    return await database.fetch_all(q, {"e": event_code})
+
+async def iter_paid_rows_for_event(event_code: str, after_id: int = 0, batch: int = 500):
+    """
+    Потоково отдаёт оплаченные покупки мероприятия (по возрастанию id),
+    порциями по batch через keyset (id > последний), не держа всё в памяти.
+    """
+    last_id = after_id
+    while True:
+        rows = await database.fetch_all(
+            """
+            SELECT id, user_id, username, ticket_type
+            FROM users
+            WHERE event_code = :e AND paid = 'оплатил' AND id > :last
+            ORDER BY id
+            LIMIT :n
+            """,
+            {"e": event_code, "last": last_id, "n": batch},
+        )
+        if not rows:
+            return
+        for r in rows:
+            yield r
+        last_id = rows[-1]["id"]
+
 async def get_paid_status_by_id(row_id: int):
     r = await database.fetch_one(select(users.c.paid).where(users.c.id == row_id))
     return r["paid"] if r else None
 
 async def set_paid_status_by_id(row_id: int, paid: str):
-    await database.execute(users.update().where(users.c.id == row_id).values(paid=paid))
+    # смена статуса гасит таймер оплаты; кому он нужен (отклонено) — ставит заново
+    if DB_FAST_PATH:
+        return await _fast_execute("set_paid", row_id, paid)
+    await database.execute(
+        users.update().where(users.c.id == row_id)
+        .values(paid=paid, pay_deadline=None, pay_msg_id=None)
+    )
 
 # ---- Подсчёты (по мероприятию и типу) ----
 async def count_ticket_type_paid_for_event(event_code: str, ticket_type: str) -> int:
     q = """
-        SELECT COUNT(*)
-        FROM users
+        SELECT COALESCE(SUM(qty), 0)::int
+        FROM ticket_counters
         WHERE event_code = :e AND ticket_type = :t AND paid = 'оплатил'
     """
     return await database.fetch_val(q, {"e": event_code, "t": ticket_type})
 
 async def count_ticket_type_for_event(event_code: str, ticket_type: str) -> int:
     q = """
-        SELECT COUNT(*)
-        FROM users
+        SELECT COALESCE(SUM(qty), 0)::int
+        FROM ticket_counters
         WHERE event_code = :e
           AND ticket_type = :t
-          AND paid <> 'не оплатил'
+          AND paid NOT IN ('не оплатил', '—')   -- '—' = NULL, в users его тоже не считали
     """
     return await database.fetch_val(q, {"e": event_code, "t": ticket_type})
+
+async def rebuild_ticket_counters():
+    """Сверка: пересобрать ticket_counters из users (блокирует счётчики на время пересборки)."""
+    async with database.transaction():
+        await database.execute("LOCK TABLE ticket_counters IN EXCLUSIVE MODE")
+        await database.execute("DELETE FROM ticket_counters")
+        await database.execute(TICKET_COUNTERS_REBUILD_SQL)
 # =============================================================================
 # Агрегаты / списки (по всем покупкам)
 # =============================================================================
@@ -188,33 +777,277 @@ async def count_paid():
     """Сколько билетов со статусом оплаты 'оплатил'."""
     return await database.fetch_val("SELECT COUNT(*) FROM users WHERE paid = 'оплатил'")
 
+async def get_report_counters():
+    """
+    Все счётчики дашборда одним запросом: продажи из ticket_counters, активации —
+    по частичному индексу ix_users_activated. Итог и разбивка по мероприятиям.
+    Возвращает (total, per_event): total — dict, per_event — список dict
+    с ключами event_code, registered, activated, paid, on_review.
+    """
+    q = """
+        SELECT
+            GROUPING(event_code) AS is_total,
+            event_code,
+            COALESCE(SUM(qty), 0)::int AS registered,
+            COALESCE(SUM(activated), 0)::int AS activated,
+            COALESCE(SUM(qty) FILTER (WHERE paid = 'оплатил'), 0)::int AS paid,
+            COALESCE(SUM(qty) FILTER (WHERE paid = 'на проверке'), 0)::int AS on_review
+        FROM (
+            SELECT event_code, paid, qty, 0 AS activated FROM ticket_counters
+            UNION ALL
+            SELECT COALESCE(event_code, '—'), NULL, 0, COUNT(*)
+            FROM users
+            WHERE status = 'активирован'
+            GROUP BY 1
+        ) c
+        GROUP BY GROUPING SETS ((event_code), ())
+        ORDER BY is_total DESC, event_code
+    """
+    rows = [dict(r) for r in await database.fetch_all(q)]
+    keys = ("registered", "activated", "paid", "on_review")
+    total = {k: 0 for k in keys}
+    per_event = []
+    for r in rows:
+        if r.pop("is_total"):
+            total = {k: r[k] for k in keys}
+        else:
+            per_event.append(r)
+    return total, per_event
+
+async def set_event_prices(event_code: str, prices: dict[str, int]):
+    """Сохранить цены мероприятия: JSON в bot_meta и строки event_prices (в одной транзакции)."""
+    try:
+        async with database.transaction():
+            await set_meta(f"prices:{event_code}", json.dumps(prices, ensure_ascii=False))
+            await database.execute(event_prices.delete().where(event_prices.c.event_code == event_code))
+            for tt, price in prices.items():
+                await database.execute(
+                    event_prices.insert().values(event_code=event_code, ticket_type=tt, price=int(price))
+                )
+    except Exception:
+        invalidate_meta(f"prices:{event_code}")   # транзакция откатилась — кэш не должен врать
+        raise
+
+async def get_revenue_by_event():
+    """
+    Выручка по мероприятиям одним запросом: счётчики оплаченных билетов группируются по
+    (event_code, канонический тип) и умножаются на цены из event_prices.
+    Любой тип, кроме 1+1 и single, считается промокодом.
+    Возвращает [{"event_code", "total", "missing"}, ...]; missing — оплаченные билеты без цены.
+    """
+    q = """
+        SELECT c.event_code,
+               COALESCE(SUM(c.cnt * p.price), 0)::bigint AS total,
+               COALESCE(SUM(c.cnt) FILTER (WHERE p.price IS NULL), 0)::int AS missing
+        FROM (
+            SELECT trim(event_code) AS event_code,
+                   CASE lower(trim(ticket_type))
+                        WHEN '1+1' THEN '1+1'
+                        WHEN 'single' THEN 'single'
+                        ELSE 'promocode'
+                   END AS tt,
+                   SUM(qty) AS cnt
+            FROM ticket_counters
+            WHERE paid = 'оплатил'
+              AND lower(trim(event_code)) NOT IN ('', 'none', '—')
+            GROUP BY 1, 2
+        ) c
+        LEFT JOIN event_prices p
+               ON p.event_code = c.event_code AND p.ticket_type = c.tt
+        GROUP BY c.event_code
+        ORDER BY c.event_code
+    """
+    return [dict(r) for r in await database.fetch_all(q)]
+
+# Полные выборки читаем порциями по ключу (keyset по id): в памяти не больше одной порции,
+# сколько бы лет истории ни лежало в users. Списочные версии оставлены для совместимости.
+async def _iter_users_desc(query, batch: int):
+    last_id = None
+    while True:
+        q = query if last_id is None else query.where(users.c.id < last_id)
+        rows = await database.fetch_all(q.order_by(desc(users.c.id)).limit(batch))
+        if not rows:
+            return
+        for r in rows:
+            yield r
+        last_id = rows[-1]["id"]
+
+async def iter_registered_users(batch: int = 1000):
+    """Все покупки (новые сначала) порциями: (user_id, username, paid, status)."""
+    q = select(users.c.id, users.c.user_id, users.c.username, users.c.paid, users.c.status)
+    async for r in _iter_users_desc(q, batch):
+        yield (r["user_id"], r["username"], r["paid"], r["status"])
+
+async def iter_paid_users(batch: int = 1000):
+    """Оплаченные покупки (новые сначала) порциями: (user_id, username, status, paid)."""
+    q = select(users.c.id, users.c.user_id, users.c.username, users.c.status, users.c.paid)\
+        .where(users.c.paid == "оплатил")
+    async for r in _iter_users_desc(q, batch):
+        yield (r["user_id"], r["username"], r["status"], r["paid"])
+
+async def iter_users_full(event_code: str | None = None, batch: int = 1000):
+    """Строки users целиком (новые сначала) порциями; с event_code — только это мероприятие."""
+    q = select(users)
+    if event_code:
+        q = q.where(users.c.event_code == event_code)
+    async for r in _iter_users_desc(q, batch):
+        yield r
+
 async def get_registered_users():
     """
     Список всех созданных покупок (для /users).
     Возвращает [(user_id, username, paid, status), ...]
     """
-    query = select(
-        users.c.user_id, users.c.username, users.c.paid, users.c.status
-    ).order_by(desc(users.c.id))
-    rows = await database.fetch_all(query)
-    return [(r.user_id, r.username, r.paid, r.status) for r in rows]
+    return [r async for r in iter_registered_users()]
 
 async def get_paid_users():
     """
     Список всех ОПЛАТИВШИХ покупок (для /paid_users).
     Возвращает [(user_id, username, status, paid), ...]
     """
-    query = select(
-        users.c.user_id, users.c.username, users.c.status, users.c.paid
-    ).where(users.c.paid == "оплатил").order_by(desc(users.c.id))
-    rows = await database.fetch_all(query)
-    return [(r.user_id, r.username, r.status, r.paid) for r in rows]
+    return [r async for r in iter_paid_users()]
+
+# ---- Задания рассылок ----
+async def create_broadcast_job(kind: str, spec: dict, reply_chat_id: int | None) -> int:
+    q = """
+        INSERT INTO broadcast_jobs(kind, spec, reply_chat_id, total)
+        VALUES (:k, :s, :c, (SELECT COUNT(*) FROM subscribers))
+        RETURNING id
+    """
+    return int(await database.fetch_val(q, {"k": kind, "s": json.dumps(spec), "c": reply_chat_id}))
+
+async def claim_broadcast_jobs(lease_sec: int, token: str):
+    """
+    Забрать в исполнение запущенные задания, чья аренда истекла (или не выдавалась).
+    token — метка владельца аренды: прежний исполнитель после этого не сможет ни продлить
+    аренду, ни записать страницу.
+    """
+    q = """
+        UPDATE broadcast_jobs
+           SET locked_until = NOW() + make_interval(secs => CAST(:l AS INT)),
+               lease_token = :t, updated_at = NOW()
+         WHERE status = 'running' AND (locked_until IS NULL OR locked_until < NOW())
+        RETURNING *
+    """
+    return await database.fetch_all(q, {"l": lease_sec, "t": token})
+
+async def renew_broadcast_lease(job_id: int, token: str, lease_sec: int) -> bool:
+    """Продлить аренду, если она всё ещё наша и задание идёт. False — аренду забрали/остановили."""
+    q = """
+        UPDATE broadcast_jobs
+           SET locked_until = NOW() + make_interval(secs => CAST(:l AS INT))
+         WHERE id = :j AND lease_token = :t AND status = 'running'
+        RETURNING id
+    """
+    return await database.fetch_val(q, {"j": job_id, "t": token, "l": lease_sec}) is not None
+
+async def get_broadcast_job(job_id: int):
+    return await database.fetch_one(select(broadcast_jobs).where(broadcast_jobs.c.id == job_id))
+
+async def list_broadcast_jobs(limit: int = 10):
+    q = select(broadcast_jobs).order_by(desc(broadcast_jobs.c.id)).limit(limit)
+    return await database.fetch_all(q)
+
+async def set_broadcast_job_status(job_id: int, status: str, from_statuses) -> bool:
+    """
+    Пауза/продолжение/отмена: меняем статус, только если текущий из from_statuses.
+    Аренду не трогаем — её отпускает исполнитель, увидев новый статус.
+    """
+    q = """
+        UPDATE broadcast_jobs
+           SET status = :s, updated_at = NOW()
+         WHERE id = :id AND status = ANY(CAST(:prev AS TEXT[]))
+        RETURNING id
+    """
+    return await database.fetch_val(q, {"id": job_id, "s": status, "prev": list(from_statuses)}) is not None
+
+async def set_broadcast_progress_msg(job_id: int, message_id: int):
+    await database.execute(
+        "UPDATE broadcast_jobs SET progress_msg_id = :m WHERE id = :id", {"id": job_id, "m": message_id}
+    )
+
+async def get_broadcast_page(job_id: int, after_uid: int, n: int) -> list[int]:
+    """Следующие n подписчиков после курсора, кроме уже получивших это задание."""
+    q = """
+        SELECT s.user_id
+          FROM subscribers s
+         WHERE s.user_id > :after
+           AND NOT EXISTS (
+                SELECT 1 FROM broadcast_deliveries d WHERE d.job_id = :j AND d.user_id = s.user_id
+           )
+         ORDER BY s.user_id
+         LIMIT :n
+    """
+    rows = await database.fetch_all(q, {"j": job_id, "after": after_uid, "n": n})
+    return [int(r["user_id"]) for r in rows]
+
+async def save_broadcast_page(job_id: int, token: str, cursor: int, outcomes: dict[int, str],
+                              lease_sec: int, done: bool = False):
+    """
+    Фиксирует итоги одной транзакцией: итоги получателей, курсор, счётчики, продление аренды.
+    Пишет, только если аренда ещё наша (lease_token), иначе ничего не меняет и возвращает None.
+    Возвращает строку задания (по status исполнитель видит паузу/отмену).
+    """
+    uids = list(outcomes)
+    values = list(outcomes.values())
+    async with database.transaction():
+        # сначала строка задания (с блокировкой) — чужая аренда отсекается до записи итогов
+        job = await database.fetch_one(
+            """
+            UPDATE broadcast_jobs
+               SET cursor = GREATEST(cursor, :c),
+                   sent = sent + :sent, blocked = blocked + :blocked, failed = failed + :failed,
+                   status = CASE WHEN :done AND status = 'running' THEN 'done' ELSE status END,
+                   -- остановились (пауза/отмена/готово) — аренду отпускаем, «Продолжить» подберёт сразу
+                   locked_until = CASE WHEN status = 'running' AND NOT :done
+                                       THEN NOW() + make_interval(secs => CAST(:l AS INT)) END,
+                   updated_at = NOW()
+             WHERE id = :j AND lease_token = :t
+            RETURNING *
+            """,
+            {
+                "j": job_id, "t": token, "c": cursor, "l": lease_sec, "done": done,
+                "sent": values.count("sent"), "blocked": values.count("blocked"), "failed": values.count("failed"),
+            },
+        )
+        if job is not None and uids:
+            await database.execute(
+                """
+                INSERT INTO broadcast_deliveries(job_id, user_id, outcome)
+                SELECT :j, u, o FROM unnest(CAST(:u AS BIGINT[]), CAST(:o AS TEXT[])) AS t(u, o)
+                ON CONFLICT DO NOTHING
+                """,
+                {"j": job_id, "u": uids, "o": values},
+            )
+        return job
+
+async def prune_broadcast_deliveries(batch: int = 5000) -> int:
+    """Удаляет итоги получателей у завершённых и отменённых рассылок (порциями). Возвращает число строк."""
+    q = """
+        DELETE FROM broadcast_deliveries
+         WHERE (job_id, user_id) IN (
+            SELECT d.job_id, d.user_id
+              FROM broadcast_deliveries d
+              JOIN broadcast_jobs j ON j.id = d.job_id
+             WHERE j.status IN ('done', 'cancelled')
+             LIMIT :n
+         )
+        RETURNING job_id
+    """
+    total = 0
+    while True:
+        rows = await database.fetch_all(q, {"n": batch})
+        total += len(rows)
+        if len(rows) < batch:
+            return total
 
 async def clear_database():
     await database.execute(users.delete())
 
 # --- Подписчики: upsert и выборка ---
 async def add_subscriber(user_id: int, username: str | None):
+    if DB_FAST_PATH:
+        return await _fast_execute("add_subscriber", user_id, username or "Без ника")
     q = """
     INSERT INTO subscribers(user_id, username, last_seen_at)
     VALUES (:uid, :uname, NOW())
@@ -224,20 +1057,91 @@ async def add_subscriber(user_id: int, username: str | None):
     """
     await database.execute(q, {"uid": user_id, "uname": (username or "Без ника")})
 
+async def iter_subscribers(batch: int = 1000):
+    """Подписчики порциями по user_id: (user_id, username)."""
+    last_uid = None
+    while True:
+        q = select(subscribers.c.user_id, subscribers.c.username)
+        if last_uid is not None:
+            q = q.where(subscribers.c.user_id > last_uid)
+        rows = await database.fetch_all(q.order_by(subscribers.c.user_id).limit(batch))
+        if not rows:
+            return
+        for r in rows:
+            yield (r["user_id"], r["username"])
+        last_uid = rows[-1]["user_id"]
+
 async def get_all_subscribers():
-    rows = await database.fetch_all("SELECT user_id, username FROM subscribers")
-    return [(r["user_id"], r["username"]) for r in rows]
+    return [r async for r in iter_subscribers()]
+
+# --- Кэш bot_meta: LRU с TTL, write-through в set_meta, кэшируем и отсутствие ключа ---
+# Глобальные ключи (цены, промокоды, последний пост) живут дольше — они меняются
+# только через set_meta этого же процесса; TTL лишь страхует от правок в обход бота.
+_META_GLOBAL_PREFIXES = ("prices:", "promocodes:", "last_channel_post_id", "SCANNER_ADMIN_IDS")
+_meta_cache: "OrderedDict[str, tuple[float, str | None]]" = OrderedDict()   # key -> (expires_at, value)
+# Чтения из БД «в полёте»: key -> [сколько чтений, версия записи]. set_meta/invalidate_meta
+# поднимают версию — прочитанное до записи значение в кэш уже не кладём.
+_meta_fetches: dict[str, list[int]] = {}
+
+def _meta_ttl(key: str) -> int:
+    return META_CACHE_TTL_GLOBAL if key.startswith(_META_GLOBAL_PREFIXES) else META_CACHE_TTL
+
+def _meta_cache_put(key: str, value: str | None):
+    if META_CACHE_SIZE <= 0:
+        return
+    _meta_cache[key] = (time.monotonic() + _meta_ttl(key), value)
+    _meta_cache.move_to_end(key)
+    while len(_meta_cache) > META_CACHE_SIZE:
+        _meta_cache.popitem(last=False)
+
+def _meta_bump(key: str | None):
+    for k, slot in _meta_fetches.items():
+        if key is None or k == key:
+            slot[1] += 1
+
+def invalidate_meta(key: str | None = None):
+    """Сбросить кэш bot_meta (один ключ или целиком)."""
+    _meta_bump(key)
+    if key is None:
+        _meta_cache.clear()
+    else:
+        _meta_cache.pop(key, None)
 
 async def set_meta(key: str, value: str):
     q = pg_insert(bot_meta).values(key=key, value=str(value)).on_conflict_do_update(
         index_elements=[bot_meta.c.key],
         set_={"value": str(value)}
     )
-    await database.execute(q)
+    try:
+        await database.execute(q)
+    except Exception:
+        invalidate_meta(key)
+        raise
+    _meta_bump(key)
+    _meta_cache_put(key, str(value))
 
 async def get_meta(key: str):
-    row = await database.fetch_one(select(bot_meta.c.value).where(bot_meta.c.key == key))
-    return row[0] if row else None
+    hit = _meta_cache.get(key)
+    if hit is not None and hit[0] > time.monotonic():
+        _meta_cache.move_to_end(key)
+        _mark_cached()
+        return hit[1]
+    slot = _meta_fetches.setdefault(key, [0, 0])
+    slot[0] += 1
+    version = slot[1]
+    try:
+        if DB_FAST_PATH:
+            row = await _fast_fetchrow("get_meta", key)
+        else:
+            row = await database.fetch_one(select(bot_meta.c.value).where(bot_meta.c.key == key))
+    finally:
+        slot[0] -= 1
+        if not slot[0]:
+            _meta_fetches.pop(key, None)
+    value = row[0] if row else None
+    if slot[1] == version:   # за время чтения ключ не писали — значение не устарело
+        _meta_cache_put(key, value)   # None тоже кэшируем (negative caching)
+    return value
 
 # Уникальные пользователи, которым шлём рассылку
 async def get_all_recipient_ids() -> list[int]:
@@ -267,41 +1171,39 @@ async def _latest_row_for_user(user_id: int):
     q = select(users).where(users.c.user_id == user_id).order_by(desc(users.c.id)).limit(1)
     return await database.fetch_one(q)
 
+async def _update_latest_row_for_user(user_id: int, **values):
+    """
+    Один UPDATE по последней записи пользователя (подзапрос по индексу (user_id, id DESC)) —
+    без отдельного SELECT и окна гонки между ними. Возвращает обновлённую запись или None.
+    """
+    latest_id = select(users.c.id).where(users.c.user_id == user_id)\
+        .order_by(desc(users.c.id)).limit(1).scalar_subquery()
+    q = users.update().where(users.c.id == latest_id).values(**values).returning(*users.c)
+    return await database.fetch_one(q)
+
 async def get_status(user_id: int):
     r = await _latest_row_for_user(user_id)
     return r["status"] if r else None
 
 async def update_status(user_id: int, status: str):
-    r = await _latest_row_for_user(user_id)
-    if not r:
-        return
-    await update_status_by_id(r["id"], status)
+    return await _update_latest_row_for_user(user_id, status=status)
 
 async def get_paid_status(user_id: int):
     r = await _latest_row_for_user(user_id)
     return r["paid"] if r else None
 
 async def set_paid_status(user_id: int, paid: str):
-    r = await _latest_row_for_user(user_id)
-    if not r:
-        return
-    await set_paid_status_by_id(r["id"], paid)
+    return await _update_latest_row_for_user(user_id, paid=paid)
 
 async def set_ticket_type(user_id: int, ticket_type: str):
-    r = await _latest_row_for_user(user_id)
-    if not r:
-        return
-    await database.execute(users.update().where(users.c.id == r["id"]).values(ticket_type=ticket_type))
+    return await _update_latest_row_for_user(user_id, ticket_type=ticket_type)
 
 async def get_ticket_type(user_id: int):
     r = await _latest_row_for_user(user_id)
     return r["ticket_type"] if r else None
 
 async def mark_as_paid(user_id: int):
-    r = await _latest_row_for_user(user_id)
-    if not r:
-        return
-    await set_paid_status_by_id(r["id"], "оплатил")
+    return await _update_latest_row_for_user(user_id, paid="оплатил")
 
 async def count_ticket_type(ticket_type: str):
     """Кол-во покупок указанного типа по всем мероприятиям (без учёта статуса оплаты)."""
@@ -349,6 +1251,7 @@ async def get_ticket_stats_grouped(paid_statuses=("оплатил",)):
     """
     Вернёт сгруппированную статистику: (event_code, ticket_type, count)
     по указанным статусам оплаты (по умолчанию только 'оплатил').
+    Читается из ticket_counters, без прохода по users.
     """
     if paid_statuses:
         placeholders = ", ".join([f":p{i}" for i in range(len(paid_statuses))])
@@ -360,12 +1263,13 @@ async def get_ticket_stats_grouped(paid_statuses=("оплатил",)):
 
     q = f"""
         SELECT
-            COALESCE(event_code, '—') AS event_code,
-            COALESCE(ticket_type, '—') AS ticket_type,
-            COUNT(*)::int AS count
-        FROM users
+            event_code,
+            ticket_type,
+            SUM(qty)::int AS count
+        FROM ticket_counters
         WHERE {where}
         GROUP BY event_code, ticket_type
+        HAVING SUM(qty) > 0
         ORDER BY event_code, ticket_type
     """
     return await database.fetch_all(q, values)
@@ -386,12 +1290,13 @@ async def get_ticket_stats_for_event(event_code: str, paid_statuses=("оплат
 
     q = f"""
         SELECT
-            COALESCE(ticket_type, '—') AS ticket_type,
-            COUNT(*)::int AS count
-        FROM users
+            ticket_type,
+            SUM(qty)::int AS count
+        FROM ticket_counters
         WHERE event_code = :e
           {paid_clause}
         GROUP BY ticket_type
+        HAVING SUM(qty) > 0
         ORDER BY ticket_type
     """
     return await database.fetch_all(q, values)
@@ -399,24 +1304,96 @@ async def get_ticket_stats_for_event(event_code: str, paid_statuses=("оплат
 
 
 from typing import Optional
-from sqlalchemy import select, desc
 
 async def get_all_users_full(event_code: Optional[str] = None):
     """
     Возвращает все строки из таблицы users.
     Если event_code задан — только по этому мероприятию.
     """
-    if event_code:
-        q = select(users).where(users.c.event_code == event_code).order_by(desc(users.c.id))
-    else:
-        q = select(users).order_by(desc(users.c.id))
-    return await database.fetch_all(q)
+    return [r async for r in iter_users_full(event_code)]
 
 
 # =========================
 # Роли/доступы
 # =========================
+# Роли держим в памяти: user_id -> битовая маска ролей. Загружаем целиком load_roles(),
+# add_role/remove_role правят таблицу сразу, периодическая перезагрузка подхватывает
+# изменения в обход процесса (другой инстанс, ручной SQL).
+# ADMIN_IDS / SCANNER_ADMIN_IDS из .env — постоянные роли поверх таблицы roles:
+# в БД не пишутся и через бота не отзываются (только правкой .env).
+_ROLE_BITS: dict[str, int] = {"admin": 1, "scanner": 2, "payments_admin": 4}
+_role_table: dict[int, int] = {}
+_roles_loaded = False
+_role_op_logs: list[list[tuple[int, int, bool]]] = []   # add/remove во время идущих load_roles
+
+def _role_bit(role: str) -> int:
+    bit = _ROLE_BITS.get(role)
+    if bit is None:
+        bit = 1 << len(_ROLE_BITS)
+        _ROLE_BITS[role] = bit
+    return bit
+
+def _roles_mask(roles_list) -> int:
+    mask = 0
+    for r in roles_list:
+        mask |= _role_bit(r)
+    return mask
+
+_env_role_table: dict[int, int] = {}
+for _uid in ADMIN_IDS:
+    _env_role_table[_uid] = _env_role_table.get(_uid, 0) | _role_bit("admin")
+for _uid in SCANNER_ADMIN_IDS:
+    _env_role_table[_uid] = _env_role_table.get(_uid, 0) | _role_bit("scanner")
+
+def is_env_role(user_id: int, role: str) -> bool:
+    """Роль выдана через .env (ADMIN_IDS / SCANNER_ADMIN_IDS) — через бота её не отозвать."""
+    return bool(_env_role_table.get(user_id, 0) & _role_bit(role))
+
+def _apply_role_op(table: dict[int, int], user_id: int, bit: int, grant: bool):
+    mask = table.get(user_id, 0) | bit if grant else table.get(user_id, 0) & ~bit
+    if mask:
+        table[user_id] = mask
+    else:
+        table.pop(user_id, None)
+
+def _record_role_op(user_id: int, role: str, grant: bool):
+    bit = _role_bit(role)
+    if _roles_loaded:
+        _apply_role_op(_role_table, user_id, bit, grant)
+    for log in _role_op_logs:
+        log.append((user_id, bit, grant))
+
+async def load_roles() -> int:
+    """(Пере)загрузить таблицу ролей из БД. Возвращает число пользователей с ролями."""
+    global _role_table, _roles_loaded
+    # add/remove, сделанные пока идёт выборка, могли не попасть в снимок — доприменим их
+    ops: list[tuple[int, int, bool]] = []
+    _role_op_logs.append(ops)
+    try:
+        rows = await database.fetch_all(
+            select(roles.c.user_id, roles.c.role).order_by(roles.c.granted_at)
+        )
+    finally:
+        _role_op_logs.remove(ops)
+    table: dict[int, int] = {}
+    for r in rows:
+        uid = int(r["user_id"])
+        table[uid] = table.get(uid, 0) | _role_bit(r["role"])
+    for uid, bit, grant in ops:
+        _apply_role_op(table, uid, bit, grant)
+    _role_table = table
+    _roles_loaded = True
+    return len(table)
+
 async def has_role(user_id: int, role: str) -> bool:
+    if is_env_role(user_id, role):
+        _mark_cached()
+        return True
+    if _roles_loaded:
+        _mark_cached()
+        return bool(_role_table.get(user_id, 0) & _role_bit(role))
+    if DB_FAST_PATH:
+        return await _fast_fetchval("has_role", user_id, role) is not None
     q = select(roles.c.user_id).where(
         roles.c.user_id == user_id,
         roles.c.role == role
@@ -424,18 +1401,53 @@ async def has_role(user_id: int, role: str) -> bool:
     row = await database.fetch_one(q)
     return row is not None
 
+async def has_any_role(user_id: int, roles_list) -> bool:
+    """Есть ли у пользователя хотя бы одна из ролей (без I/O, если роли загружены)."""
+    mask = _roles_mask(roles_list)
+    if _env_role_table.get(user_id, 0) & mask:
+        _mark_cached()
+        return True
+    if _roles_loaded:
+        _mark_cached()
+        return bool(_role_table.get(user_id, 0) & mask)
+    q = select(roles.c.user_id).where(
+        roles.c.user_id == user_id,
+        roles.c.role.in_(list(roles_list))
+    ).limit(1)
+    row = await database.fetch_one(q)
+    return row is not None
+
 async def add_role(user_id: int, role: str) -> None:
     q = pg_insert(roles).values(user_id=user_id, role=role)\
         .on_conflict_do_nothing(index_elements=[roles.c.user_id, roles.c.role])
     await database.execute(q)
+    _record_role_op(user_id, role, True)
 
 async def remove_role(user_id: int, role: str) -> None:
     await database.execute(
         roles.delete().where(roles.c.user_id == user_id, roles.c.role == role)
     )
+    _record_role_op(user_id, role, False)
 
 async def get_role_user_ids(role: str) -> list[int]:
-    rows = await database.fetch_all(
-        select(roles.c.user_id).where(roles.c.role == role)
-    )
-    return [int(r[0]) for r in rows]
+    bit = _role_bit(role)
+    env_ids = [uid for uid, mask in _env_role_table.items() if mask & bit]
+    if _roles_loaded:
+        _mark_cached()
+        ids = [uid for uid, mask in _role_table.items() if mask & bit]
+    else:
+        rows = await database.fetch_all(
+            select(roles.c.user_id).where(roles.c.role == role)
+        )
+        ids = [int(r[0]) for r in rows]
+    return ids + [uid for uid in env_ids if uid not in ids]
+
+
+# Публичные async-функции модуля — с замером времени (db_stats). Держать в самом конце файла.
+# Приватные хелперы (_fast_* и т.п.) не оборачиваем: их время уже учтено в вызывающей функции.
+for _name, _fn in list(globals().items()):
+    if (inspect.iscoroutinefunction(_fn) and _fn.__module__ == __name__
+            and not _name.startswith("_")
+            and _name not in ("connect_db", "disconnect_db")):
+        globals()[_name] = _timed(_fn)
+del _name, _fn
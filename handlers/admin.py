@@ -2,32 +2,43 @@ from aiogram import Router, F
 import config
 import json
 import asyncio
-from config import INSTAGRAM_LINK, ADMIN_BROADCAST_PASSWORD
+import os
+import tempfile
+from config import ADMIN_BROADCAST_PASSWORD
 import re
 from openpyxl import Workbook
 from io import BytesIO
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import StateFilter, Command
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import (
     Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
     FSInputFile, BufferedInputFile, BotCommand, BotCommandScopeChat
 )
-from qr_generator import generate_qr
+from qr_generator import (
+    generate_qr, make_payload, parse_payload, QrRenderBusy,
+    PAYLOAD_SIGNED, PAYLOAD_LEGACY, PAYLOAD_FORGED, PAYLOAD_OTHER_EVENT,
+)
+import ticket_index
+import payment_expiry
+import broadcast_jobs
+from prerender_qr import prerender_event, build_zip, build_sheet_pdf
 from database import (
     # работа по row_id
     get_row, get_paid_status_by_id, set_paid_status_by_id,
-    get_status_by_id, update_status_by_id, get_status, update_status,
+    CHECKIN_ACTIVATED, CHECKIN_NOT_FOUND,
     # отчёты / списки
-    count_registered, count_activated, count_paid,
+    get_report_counters,
     get_registered_users, get_paid_users,
     # обслуживание
     clear_database, get_unique_one_plus_one_attempters_for_event,
-    get_all_subscribers, set_meta, get_meta, get_all_recipient_ids,
-    set_one_plus_one_limit, get_one_plus_one_limit,
-    count_one_plus_one_taken, remaining_one_plus_one_for_event,
+    set_meta, get_meta, get_all_recipient_ids,
+    set_one_plus_one_limit,
+    count_one_plus_one_taken,
     get_ticket_stats_grouped, get_ticket_stats_for_event,
-    get_all_users_full, get_all_subscribers, has_role, add_role, remove_role, get_role_user_ids,
+    iter_users_full, set_event_prices,
+    list_broadcast_jobs, get_broadcast_job, set_broadcast_job_status, get_revenue_by_event, has_role, has_any_role, add_role, remove_role, get_role_user_ids, is_env_role,
 )
 from config import SCAN_WEBAPP_URL, CHANNEL_ID, PAYMENT_LINK, ADMIN_EVENT_PASSWORD
 
@@ -39,7 +50,7 @@ async def is_full_admin(uid: int) -> bool:
 
 async def _can_use_scanner(uid: int) -> bool:
     # сканер-доступ у сканер-админов и у полноценных админов
-    return await has_role(uid, "admin") or await has_role(uid, "scanner")
+    return await has_any_role(uid, ("admin", "scanner"))
 
 
 # =========================
@@ -97,6 +108,8 @@ def _kb_event_tools() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔁 Сменить мероприятие", callback_data="change_event_menu")],
         [InlineKeyboardButton(text="📣 Разослать последний пост", callback_data="broadcast_last")],
+        [InlineKeyboardButton(text="📋 Рассылки", callback_data="bj:list")],
+        [InlineKeyboardButton(text="🖨 Подготовить QR (ZIP + PDF)", callback_data="ev:prerender")],
         [InlineKeyboardButton(text="📷 Открыть сканер", url=SCAN_WEBAPP_URL)],
     ])
 
@@ -175,7 +188,7 @@ async def cb_adm_clear_db(callback: CallbackQuery, state: FSMContext):
 
 # =========================
 # Сканирование через WebApp
-# Ожидаем payload вида "row_id:ticket_type"
+# Ожидаем подписанный "T1_…" или старый "row_id" / "R:<row_id>" / "row_id:ticket_type"
 # =========================
 @router.message(lambda msg: msg.web_app_data is not None)
 async def handle_webapp_data(message: Message):
@@ -187,52 +200,25 @@ async def handle_webapp_data(message: Message):
         await message.answer("⚠️ Пустые данные из сканера.")
         return
 
-    # 1) Старый формат (как раньше): в payload чистое число (user_id)
-    if payload.isdigit():
-        user_id = int(payload)
-        status = await get_status(user_id)
-        if status is None:
-            await message.answer("❌ QR-код не найден.")
-        elif status == "не активирован":
-            await update_status(user_id, "активирован")
-            await message.answer("✅ Пропуск активирован. Удачного мероприятия!")
-        else:
-            await message.answer("⚠️ Этот QR-код уже был использован.")
+    # Подпись и мероприятие проверяем локально — до любого запроса к БД.
+    # Старые форматы: <число>, R:<row_id>, QR:<...>, <row_id>:что-угодно
+    kind, candidate, _signed_type = parse_payload(payload, config.EVENT_CODE)
+    if kind == PAYLOAD_OTHER_EVENT:
+        await message.answer("❌ Этот QR-код от другого мероприятия.")
         return
-
-    # 2) Совместимость с новым форматом: R:<row_id>, QR:<...>, <row_id>:что-угодно
-    p = payload.lstrip()
-    if p.lower().startswith("qr:"):
-        p = p[3:].lstrip()
-    if p.lower().startswith("r:"):
-        p = p[2:].lstrip()
-
-    num_str = p.split(":", 1)[0]
-    try:
-        candidate = int(num_str)
-    except ValueError:
-        await message.answer("⚠️ Неверный формат QR.")
+    if kind == PAYLOAD_FORGED:
+        await message.answer("❌ Недействительный QR-код.")
         return
-
-    # Сначала попробуем, как раньше, трактовать число как user_id (если сканер всё ещё шлёт user_id с префиксом)
-    status = await get_status(candidate)
-    if status is not None:
-        if status == "не активирован":
-            await update_status(candidate, "активирован")
-            await message.answer("✅ Пропуск активирован. Удачного мероприятия!")
-        else:
-            await message.answer("⚠️ Этот QR-код уже был использован.")
+    if kind not in (PAYLOAD_SIGNED, PAYLOAD_LEGACY):
+        await message.answer("⚠️ Неверный формат QR.")
         return
 
-    # Иначе это row_id — новая схема (одна покупка = одна строка)
-    row = await get_row(candidate)
-    if row is None:
+    # Подписанный QR — это точно row_id; голое число — user_id (старые QR) или row_id.
+    # Индекс в памяти, в БД — только активация
+    result, _row = await ticket_index.checkin(candidate, legacy=(kind == PAYLOAD_LEGACY))
+    if result == CHECKIN_NOT_FOUND:
         await message.answer("❌ QR-код не найден.")
-        return
-
-    status_by_id = await get_status_by_id(candidate)
-    if status_by_id == "не активирован":
-        await update_status_by_id(candidate, "активирован")
+    elif result == CHECKIN_ACTIVATED:
         await message.answer("✅ Пропуск активирован. Удачного мероприятия!")
     else:
         await message.answer("⚠️ Этот QR-код уже был использован.")
@@ -313,6 +299,83 @@ async def scanner_command(message: Message):
     await message.answer("Сканируйте QR-код участника:", reply_markup=keyboard)    
 
     
+# =========================
+# Отправка QR-билета: повторно — по Telegram file_id, без рендера и загрузки
+# =========================
+def _qr_file_id_key(row_id: int, event_code, ticket_type) -> str:
+    # ключ — сама подписанная нагрузка (как у кэша PNG): смена QR_SECRET или типа билета
+    # даёт новый ключ, и старую картинку, которую вход отклонит, повторно не отправим
+    return f"qr_file_id:{make_payload(row_id, event_code, ticket_type)}"
+
+async def _send_ticket_qr(bot, chat_id: int, row_id: int, event_code, ticket_type, caption: str):
+    file_id = await get_meta(_qr_file_id_key(row_id, event_code, ticket_type))
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption)
+        except TelegramBadRequest:
+            pass  # file_id протух — загрузим заново
+
+    png_bytes = await generate_qr(row_id, event_code, ticket_type)
+    photo = BufferedInputFile(png_bytes, filename=f"ticket_{row_id}.png")
+    sent = await bot.send_photo(chat_id=chat_id, photo=photo, caption=caption)
+    try:
+        await set_meta(_qr_file_id_key(row_id, event_code, ticket_type), sent.photo[-1].file_id)
+    except Exception:
+        pass
+    return sent
+
+# =========================
+# /prerender_qr — заранее отрисовать QR всех оплаченных билетов текущего мероприятия
+# =========================
+@router.message(lambda m: m.text == "/prerender_qr")
+async def prerender_qr_cmd(message: Message):
+    if not await is_full_admin(message.from_user.id):
+        await message.answer("🚫 У вас нет прав для этой команды.")
+        return
+    asyncio.create_task(_prerender_qr_to(message.bot, message.chat.id))
+
+@router.callback_query(F.data == "ev:prerender")
+async def cb_ev_prerender(callback: CallbackQuery):
+    if not await is_full_admin(callback.from_user.id):
+        await callback.answer("Нет прав.", show_alert=True); return
+    await callback.answer()
+    asyncio.create_task(_prerender_qr_to(callback.bot, callback.from_user.id))
+
+async def _prerender_qr_to(bot, chat_id: int):
+    ev = config.EVENT_CODE
+    if (ev or "").strip().lower() == "none":
+        await bot.send_message(chat_id, "Сейчас нет активного мероприятия.")
+        return
+    status_msg = await bot.send_message(chat_id, f"🖨 Готовлю QR для «{ev}»…")
+
+    async def progress(done, rendered):
+        try:
+            await bot.edit_message_text(
+                f"🖨 «{ev}»: обработано {done}, отрисовано {rendered}…",
+                chat_id=chat_id, message_id=status_msg.message_id,
+            )
+        except Exception:
+            pass
+
+    try:
+        done, rendered = await prerender_event(ev, progress)
+        await progress(done, rendered)
+        if not done:
+            await bot.send_message(chat_id, "Оплаченных билетов нет.")
+            return
+        # ZIP и PDF собираются во временные файлы потоково — в памяти не держим всё мероприятие
+        with tempfile.TemporaryDirectory() as tmp:
+            zip_path = os.path.join(tmp, f"qr_{ev}.zip")
+            n = await build_zip(ev, zip_path)
+            await bot.send_document(chat_id, FSInputFile(zip_path, filename=f"qr_{ev}.zip"),
+                                    caption=f"📦 QR-билеты «{ev}»: {n}")
+            pdf_path = os.path.join(tmp, f"qr_{ev}.pdf")
+            if await build_sheet_pdf(ev, pdf_path):
+                await bot.send_document(chat_id, FSInputFile(pdf_path, filename=f"qr_{ev}.pdf"),
+                                        caption="🖨 Лист для печати (офлайн-список на входе)")
+    except Exception as e:
+        await bot.send_message(chat_id, f"⚠️ Пре-рендер прерван: {e}\nПовторный запуск продолжит с места остановки.")
+
 # =========================
 # Подтверждение оплаты по row_id
 # =========================
@@ -328,24 +391,34 @@ async def approve_payment(callback: CallbackQuery):
 
     # ставим оплату и генерим QR
     await set_paid_status_by_id(row_id, "оплатил")
+    ticket_index.add(row_id, row["user_id"], row["ticket_type"], row["status"], event_code=row["event_code"])
 
     ticket_type = row["ticket_type"]
     event_code = row["event_code"] or "-"   # <-- вместо row.get(...)
 
-    png_bytes = await generate_qr(row_id)
-    photo = BufferedInputFile(png_bytes, filename=f"ticket_{row_id}.png")
-
-    await callback.bot.send_photo(
-        chat_id=row["user_id"],
-        photo=photo,
-        caption=(
-            f"🎉 Оплата подтверждена! Покажи этот QR на входе\n\n"
-            f"Твой билет №{row_id}\n"
-            f"Тип: {ticket_type}\n"
-            f"Мероприятие: {event_code}\n\n"
-            f"До встречи на тусовке 🫶"
+    try:
+        await _send_ticket_qr(
+            callback.bot,
+            chat_id=row["user_id"],
+            row_id=row_id,
+            event_code=row["event_code"],
+            ticket_type=ticket_type,
+            caption=(
+                f"🎉 Оплата подтверждена! Покажи этот QR на входе\n\n"
+                f"Твой билет №{row_id}\n"
+                f"Тип: {ticket_type}\n"
+                f"Мероприятие: {event_code}\n\n"
+                f"До встречи на тусовке 🫶"
+            )
         )
-    )
+    except QrRenderBusy:
+        # оплата уже проставлена; повторное «Подтвердить» просто отправит QR
+        await callback.message.edit_text(
+            f"⏳ Оплата по билету #{row_id} подтверждена, но QR сейчас не отрисовать — перегрузка.\n"
+            f"Нажмите «Подтвердить» ещё раз через минуту.",
+            reply_markup=callback.message.reply_markup,
+        )
+        return
 
     await callback.message.edit_text(f"✅ Подтверждено. QR по билету #{row_id} отправлен пользователю.")
     
@@ -372,6 +445,7 @@ async def reject_payment(callback: CallbackQuery):
         return
 
     await set_paid_status_by_id(row_id, "отклонено")
+    ticket_index.remove(row_id)
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💳 Оплатить", url=PAYMENT_LINK)],
@@ -396,16 +470,8 @@ async def reject_payment(callback: CallbackQuery):
             pass
     await set_meta(f"review_msg:{uid}", "")
     
-    # ⏱️ Запускаем новый 5-минутный таймер после отклонения
-    asyncio.create_task(
-        _expire_payment_after_admin(
-            bot=callback.bot,
-            chat_id=row["user_id"],
-            message_id=sent.message_id,
-            row_id=row_id,
-            timeout_sec=300  # 5 минут
-        )
-    )
+    # ⏱️ Новый 5-минутный таймер после отклонения (дедлайн в БД, см. payment_expiry)
+    await payment_expiry.schedule(row_id, sent.message_id)
     
     await callback.message.edit_text(f"❌ Оплата по билету #{row_id} отклонена. Пользователь уведомлён.")
 
@@ -431,6 +497,7 @@ async def process_password(message: Message, state: FSMContext):
     from config import ADMIN_EVENT_PASSWORD
     if (message.text or "").strip() == (ADMIN_EVENT_PASSWORD or ""):
         await clear_database()
+        await ticket_index.load(config.EVENT_CODE)
         await message.answer("✅ База данных успешно очищена.")
     else:
         await message.answer("❌ Неверный пароль. Доступ запрещён.")
@@ -517,6 +584,7 @@ async def change_event_check_password(message: Message, state: FSMContext):
     # Режим: выключить продажи — просто ставим EVENT_CODE = "none"
     if mode == "off":
         config.EVENT_CODE = "none"
+        ticket_index.clear()
         await state.clear()
         await message.answer(
             "🛑 Продажи остановлены.\n"
@@ -546,7 +614,7 @@ async def change_event_set_name(message: Message, state: FSMContext):
 
     # Меняем активное событие "на лету"
     config.EVENT_CODE = new
-
+    await ticket_index.load(new)
 
     # Сохраним во FSM, нужно ли потом делать рассылку
     await state.update_data(
@@ -659,9 +727,9 @@ async def change_event_promocodes(message: Message, state: FSMContext):
     }
 
     # Сохраняем в bot_meta (per-event)
-    # ключи: prices:<EVENT_CODE> и promocodes:<EVENT_CODE>
+    # ключи: prices:<EVENT_CODE> (+ таблица event_prices) и promocodes:<EVENT_CODE>
     try:
-        await set_meta(f"prices:{new_event}", json.dumps(prices, ensure_ascii=False))
+        await set_event_prices(new_event, prices)
         await set_meta(f"promocodes:{new_event}", json.dumps(codes, ensure_ascii=False))
     except Exception:
         # не падаем в случае мелких проблем БД
@@ -691,7 +759,7 @@ async def change_event_promocodes(message: Message, state: FSMContext):
     # Если раньше было none → стало не none — шлём анонс (как раньше)
     if broadcast_needed:
         await message.answer("📣 Сначала рассылаю последний пост канала, затем уведомление с кнопкой…")
-        asyncio.create_task(_broadcast_last_post_then_notice(message.bot, new_event))
+        await _broadcast_last_post_then_notice(message.bot, new_event, message.chat.id)
 
 # =========================
 # Счётчик желающих 1+1
@@ -704,120 +772,18 @@ async def list_1plus1_wishers(message: Message):
     await _send_wishers_to(message.bot, message.chat.id)
 
 
-# =========================
-# Локальный хелпер таймера
-# =========================
-
-async def _expire_payment_after_admin(bot, chat_id: int, message_id: int, row_id: int, timeout_sec: int = 300):
-    await asyncio.sleep(timeout_sec)
-
-    # узнаем тип билета и событие (важно для 1+1)
-    row = await get_row(row_id)
-    ticket_type = (row["ticket_type"] or "").strip().lower() if row else ""
-    event_code = row["event_code"] if row else None
-
-    from database import get_paid_status_by_id
-    status = await get_paid_status_by_id(row_id)
-
-    if status in ("не оплатил", "отклонено"):
-                # если было «отклонено», переводим в «не оплатил»
-        if status == "отклонено":
-            try:
-                await set_paid_status_by_id(row_id, "не оплатил")
-            except Exception:
-                pass
-        try:
-            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
-        except Exception:
-            pass
-
-        kb = await _purchase_menu_kb()
-        
-        await bot.send_message(
-            chat_id,
-            "⏰ Время оплаты истекло.\nВыберите тип билета заново:",
-            reply_markup=kb
-        )
-        
-        # если освободился слот 1+1 — предупредим желающих
-        if ticket_type == "1+1" and event_code:
-            await _notify_wishers_1p1_available(bot, event_code)
-
-
 # =========================
 # Хелпер для рассылки:
 # =========================
 
-async def _broadcast_new_event(bot, event_title: str):
-    subs = await get_all_subscribers()
-    if not subs:
-        return
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Подписаться на Telegram", url=f"https://t.me/{CHANNEL_ID.lstrip('@')}")],
-        [InlineKeyboardButton(text="📷 Подписаться на Instagram", url=INSTAGRAM_LINK)],
-        [InlineKeyboardButton(text="🎟 Оплатить билет", callback_data="buy_ticket_menu")]        
-    ])
-    text = (
-        f"🔥 Новое мероприятие: {event_title}\n\n"
-        "Билеты уже доступны — не забудь купить👇"
-    )
-    # Telegram: не чаще ~30 сообщений/сек. Пойдём мягко — 20/сек.
-    for uid, _uname in subs:
-        try:
-            await bot.send_message(uid, text, reply_markup=kb)
-            await asyncio.sleep(0.05)
-        except Exception:
-            # игнорируем блокировки и пр.
-            await asyncio.sleep(0.05)
-
-async def _broadcast_last_post_then_notice(bot, event_title: str):
+# Рассылки — сохранённые задания (broadcast_jobs): переживают рестарт, ставятся на паузу/отменяются
+async def _broadcast_last_post_then_notice(bot, event_title: str, reply_chat_id: int | None = None):
     post_id = await get_meta(LAST_POST_KEY)  # может быть None, тогда просто шлём уведомление
-    subs = await get_all_subscribers()
-    if not subs:
-        return
-
-    # Клавиатуры
-    kb_notice_subscribed = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎟 Оплатить билет", callback_data="buy_ticket_menu")]
-    ])
-    kb_notice_unsubscribed = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Подписаться на Telegram", url=f"https://t.me/{CHANNEL_ID.lstrip('@')}")],
-        [InlineKeyboardButton(text="📷 Подписаться на Instagram", url=INSTAGRAM_LINK)],
-        [InlineKeyboardButton(text="🎟 Оплатить билет", callback_data="buy_ticket_menu")]
-    ])
-
-    for uid, _uname in subs:
-        # 1) копируем последний пост (если известен)
-        if post_id:
-            try:
-                await bot.copy_message(chat_id=uid, from_chat_id=CHANNEL_ID, message_id=int(post_id))
-            except Exception:
-                pass  # игнорируем тех, к кому не доставили
-
-        # 2) проверяем подписку на канал
-        subscribed = False
-        try:
-            member = await bot.get_chat_member(CHANNEL_ID, uid)
-            status = getattr(member, "status", None)
-            subscribed = status in ("member", "administrator", "creator")
-        except Exception:
-            # не смогли проверить — считаем, что не подписан
-            subscribed = False
-
-        kb = kb_notice_subscribed if subscribed else kb_notice_unsubscribed
-
-        # 3) отправляем уведомление
-        try:
-            await bot.send_message(
-                uid,
-                f"🔥 Новое мероприятие: {event_title}\n\nБилеты уже доступны — жми ниже 👇",
-                reply_markup=kb
-            )
-        except Exception:
-            pass
-
-        # ограничим скорость (≈20 сообщений/сек)
-        await asyncio.sleep(0.05)
+    return await broadcast_jobs.start(
+        bot, broadcast_jobs.KIND_EVENT_NOTICE,
+        {"post_id": int(post_id) if post_id else None, "event_title": event_title},
+        reply_chat_id,
+    )
 
 
 # =========================
@@ -839,7 +805,7 @@ async def broadcast_last_check_password(message: Message, state: FSMContext):
         return
 
     await state.clear()
-    await message.answer("✅ Пароль принят. Начинаю рассылку…")
+    await message.answer("✅ Пароль принят. Начинаю рассылку (прогресс — ниже, /broadcasts — все рассылки)…")
     await _broadcast_last_post(message.bot, message)
     
 LAST_POST_KEY = "last_channel_post_id"
@@ -869,24 +835,7 @@ async def _broadcast_last_post(bot, reply_target):
         )
         return
 
-    subs = await get_all_subscribers()
-    if not subs:
-        await reply_target.answer("Сейчас нет подписчиков для рассылки.")
-        return
-
-    sent, skipped = 0, 0
-    for uid, _uname in subs:
-        try:
-            await bot.copy_message(
-                chat_id=uid,
-                from_chat_id=CHANNEL_ID,    # может быть @username
-                message_id=int(post_id)
-            )
-            sent += 1
-        except Exception:
-            skipped += 1
-
-    await reply_target.answer(f"📣 Готово. Отправлено: {sent}, пропущено: {skipped}.")
+    await broadcast_jobs.start(bot, broadcast_jobs.KIND_COPY_POST, {"post_id": int(post_id)}, reply_target.chat.id)
 
 @router.message(lambda m: m.text == "/broadcast_last")
 async def broadcast_last_cmd(message: Message, state: FSMContext):
@@ -903,6 +852,55 @@ async def broadcast_last_cb(callback: CallbackQuery, state: FSMContext):
     await state.set_state(BroadcastLastStates.waiting_for_password)
     await callback.message.answer("🔒 Введите пароль для рассылки последнего поста канала:")
 
+# ---- Задания рассылок: список, пауза / продолжение / отмена ----
+async def _send_broadcast_jobs_to(bot, chat_id: int):
+    jobs = await list_broadcast_jobs()
+    if not jobs:
+        await bot.send_message(chat_id, "Рассылок ещё не было.")
+        return
+    for job in jobs:
+        await bot.send_message(chat_id, broadcast_jobs.progress_text(job), reply_markup=broadcast_jobs.job_kb(job))
+
+@router.message(lambda m: m.text == "/broadcasts")
+async def broadcast_jobs_cmd(message: Message):
+    if not await is_full_admin(message.from_user.id):
+        return
+    await _send_broadcast_jobs_to(message.bot, message.chat.id)
+
+@router.callback_query(F.data.startswith("bj:"))
+async def broadcast_job_action(callback: CallbackQuery):
+    if not await is_full_admin(callback.from_user.id):
+        await callback.answer("Нет прав.", show_alert=True)
+        return
+    _, action, *rest = callback.data.split(":")
+    if action == "list":
+        await callback.answer()
+        await _send_broadcast_jobs_to(callback.bot, callback.message.chat.id)
+        return
+
+    job_id = int(rest[0])
+    transitions = {
+        "pause": ("paused", ("running",)),
+        "resume": ("running", ("paused",)),
+        "cancel": ("cancelled", ("running", "paused")),
+    }
+    if action in transitions:
+        status, from_statuses = transitions[action]
+        changed = await set_broadcast_job_status(job_id, status, from_statuses)
+        if changed and action == "resume":
+            broadcast_jobs.wake()
+        await callback.answer("Готово." if changed else "Статус уже изменился.")
+    else:
+        await callback.answer()
+
+    job = await get_broadcast_job(job_id)
+    if not job:
+        return
+    try:
+        await callback.message.edit_text(broadcast_jobs.progress_text(job), reply_markup=broadcast_jobs.job_kb(job))
+    except TelegramBadRequest:
+        pass   # текст не изменился
+
 # =========================
 # Добавление админов:
 # =========================
@@ -1001,7 +999,7 @@ async def scan_access_add_id(message: Message, state: FSMContext):
         await message.answer("user_id должен быть числом. Попробуйте снова или нажмите «Отмена».",
                              reply_markup=_scan_cancel_kb()); return
 
-    if await has_role(uid, "admin") or await has_role(uid, "scanner"):
+    if await has_any_role(uid, ("admin", "scanner")):
         await message.answer("✅ У пользователя уже есть доступ к сканеру.")
     else:
         await add_role(uid, "scanner")
@@ -1036,6 +1034,8 @@ async def scan_access_remove_id(message: Message, state: FSMContext):
         await message.answer("🚫 Нельзя отозвать доступ у полного админа (роль 'admin').")
     elif not await has_role(uid, "scanner"):
         await message.answer("ℹ️ У пользователя и так нет прав сканера.")
+    elif is_env_role(uid, "scanner"):
+        await message.answer("🚫 Доступ выдан в настройках (SCANNER_ADMIN_IDS) — уберите id оттуда.")
     else:
         await remove_role(uid, "scanner")
         await message.answer(f"✅ Доступ к сканеру отозван: {uid}")
@@ -1059,60 +1059,6 @@ async def scan_access_menu_cmd(message: Message):
 
 
 
-async def _purchase_menu_kb() -> InlineKeyboardMarkup:
-    rows = []
-    try:
-        limit = await get_one_plus_one_limit(config.EVENT_CODE)
-    except Exception:
-        limit = None
-
-    if limit and limit > 0:
-        rows.append([InlineKeyboardButton(text="🎫 Билет 1+1", callback_data="ticket_1plus1")])
-
-    rows.append([InlineKeyboardButton(text="🎫 1 билет", callback_data="ticket_single")])
-    rows.append([InlineKeyboardButton(text="🎟 У меня есть промокод", callback_data="ticket_promocode")])
-    rows.append([InlineKeyboardButton(text="⬅️ Вернуться назад", callback_data="back:start")])
-
-    return InlineKeyboardMarkup(inline_keyboard=rows)
-
-async def _notify_wishers_1p1_available(bot, event_code: str):
-    """
-    Шлём уведомления тем, кто пытался взять 1+1,
-    когда слоты были заняты. Не больше текущего остатка.
-    """
-    remaining = await remaining_one_plus_one_for_event(event_code)
-    if remaining is None or remaining <= 0:
-        return
-
-    rows = await get_unique_one_plus_one_attempters_for_event(event_code)
-    if not rows:
-        return
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎟 Оплатить билет", callback_data="ticket_1plus1")],
-        [InlineKeyboardButton(text="⬅️ Вернуться назад", callback_data="back:ticket")],
-    ])
-
-    sent = 0
-    for r in rows:
-        uid = int(r["user_id"])
-        try:
-            await bot.send_message(
-                uid,
-                f"✨ Освободились билеты 1+1 на «{event_code}». Успей забрать 👇",
-                reply_markup=kb
-            )
-            sent += 1
-        except Exception:
-            pass
-
-        if sent >= remaining:
-            break
-
-        await asyncio.sleep(0.05)  # мягкий rate-limit
-
-
-
 # ===============================================
 # ==== helpers: цены и промокоды для события ====
 # ===============================================
@@ -1179,7 +1125,7 @@ def _parse_promocodes(text: str) -> list[str]:
     return out
 
 async def _save_event_prices(event_code: str, prices: dict[str, int]):
-    await set_meta(f"prices:{event_code}", json.dumps(prices, ensure_ascii=False))
+    await set_event_prices(event_code, prices)
 
 async def _load_event_prices(event_code: str) -> dict[str, int] | None:
     raw = await get_meta(f"prices:{event_code}")
@@ -1193,65 +1139,18 @@ async def _load_event_prices(event_code: str) -> dict[str, int] | None:
 def _fmt_amount(n: int) -> str:
     return f"{n:,}".replace(",", " ")
 
-def _canon_type(t: str) -> str:
-    s = (t or "").strip().lower()
-    if s == "1+1":
-        return "1+1"
-    if s == "single":
-        return "single"
-    # всё остальное считаем промокодами
-    return "promocode"
-
-async def _calc_revenue_for_event(event_code: str) -> tuple[int, int]:
-    if not event_code or event_code.strip().lower() == "none":
-        return 0, 0
-
-    rows = await get_all_users_full(event_code)
-    prices = await _load_event_prices(event_code) or {}
-    total = 0
-    missing = 0
-
-    for r in rows or []:
-        d = dict(r)  # ← ключевая правка
-        paid = (d.get("paid") or "").strip().lower()
-        if paid != "оплатил":
-            continue
-        tt = _canon_type(d.get("ticket_type"))
-        price = prices.get(tt)
-        if isinstance(price, int):
-            total += price
-        else:
-            missing += 1
-    return total, missing
-
-
-async def _calc_revenue_all_events() -> tuple[int, int]:
-    rows = await get_all_users_full(None)
-    total = 0
-    missing = 0
-    cache: dict[str, dict] = {}
-
-    for r in rows or []:
-        d = dict(r)  # ← ключевая правка
-        paid = (d.get("paid") or "").strip().lower()
-        if paid != "оплатил":
-            continue
-
-        ev = (d.get("event_code") or "").strip()
-        if not ev or ev.lower() == "none":
-            continue
-
-        if ev not in cache:
-            cache[ev] = await _load_event_prices(ev) or {}
-
-        tt = _canon_type(d.get("ticket_type"))
-        price = cache[ev].get(tt)
-        if isinstance(price, int):
-            total += price
-        else:
-            missing += 1
-
-    return total, missing
+async def _calc_revenue() -> tuple[dict[str, tuple[int, int]], int, int]:
+    """
+    Выручка считается в БД (get_revenue_by_event) — сюда приходит по строке на мероприятие.
+    Возвращает ({event_code: (total, missing)}, total_all, missing_all).
+    """
+    rows = await get_revenue_by_event()
+    by_event = {r["event_code"]: (int(r["total"]), int(r["missing"])) for r in rows}
+    return (
+        by_event,
+        sum(t for t, _ in by_event.values()),
+        sum(m for _, m in by_event.values()),
+    )
 
 
 @router.callback_query(F.data == "an:revenue")
@@ -1262,8 +1161,8 @@ async def cb_an_revenue(callback: CallbackQuery):
     await callback.answer("Считаю…", show_alert=False)
 
     cur_ev = config.EVENT_CODE
-    cur_total, cur_missing = await _calc_revenue_for_event(cur_ev)
-    all_total, all_missing = await _calc_revenue_all_events()
+    by_event, all_total, all_missing = await _calc_revenue()
+    cur_total, cur_missing = by_event.get((cur_ev or "").strip(), (0, 0))
 
     lines = ["💰 Выручка"]
     if cur_ev and cur_ev.strip().lower() != "none":
@@ -1296,19 +1195,25 @@ async def _load_event_promocodes(event_code: str) -> list[str] | None:
 
 
 async def _send_report_to(bot, chat_id: int):
-    total = await count_registered()
-    active = await count_activated()
-    inactive = total - active
-    chat_count = await bot.get_chat_member_count(CHANNEL_ID)
-    paid_count = await count_paid()
-    await bot.send_message(
-        chat_id,
-        f"📊 Статистика:\n"
-        f"👥 Подписчиков в канале: {chat_count}\n"
-        f"👤 Создано покупок: {total}\n"
-        f"💰 Оплачено: {paid_count}\n"
-        f"✅ Пришли: {active}"
+    # Один агрегирующий запрос к БД параллельно с запросом к Telegram
+    (total, per_event), chat_count = await asyncio.gather(
+        get_report_counters(),
+        bot.get_chat_member_count(CHANNEL_ID),
     )
+    lines = [
+        "📊 Статистика:",
+        f"👥 Подписчиков в канале: {chat_count}",
+        f"👤 Создано покупок: {total['registered']}",
+        f"💰 Оплачено: {total['paid']}",
+        f"✅ Пришли: {total['activated']}",
+    ]
+    if per_event:
+        lines.append("")
+        lines.append("По мероприятиям (оплачено / пришли / покупок):")
+        for r in per_event:
+            mark = "▶️ " if r["event_code"] == config.EVENT_CODE else "• "
+            lines.append(f"{mark}{r['event_code']}: {r['paid']} / {r['activated']} / {r['registered']}")
+    await bot.send_message(chat_id, "\n".join(lines))
 
 async def _send_stats_this_to(bot, chat_id: int):
     ev = config.EVENT_CODE
@@ -1344,14 +1249,16 @@ async def _send_wishers_to(bot, chat_id: int):
         await bot.send_message(chat_id, text)
 
 async def _send_export_to(bot, chat_id: int, only_this: bool):
-    rows = await get_all_users_full(config.EVENT_CODE if only_this else None)
-    if not rows:
-        await bot.send_message(chat_id, "Данных нет.")
-        return
-    wb = Workbook(); ws = wb.active; ws.title = "users"
+    # Строки читаем порциями и сразу пишем в write-only книгу — память не растёт с размером таблицы
+    wb = Workbook(write_only=True); ws = wb.create_sheet("users")
     ws.append(["id","user_id","username","event_code","ticket_type","paid","status","purchase_date"])
-    for r in rows:
+    n = 0
+    async for r in iter_users_full(config.EVENT_CODE if only_this else None):
         ws.append([r["id"], r["user_id"], r["username"], r["event_code"], r["ticket_type"], r["paid"], r["status"], r["purchase_date"]])
+        n += 1
+    if not n:
+        await bot.send_message(chat_id, "Данных нет.")
+        return
     buf = BytesIO(); wb.save(buf); buf.seek(0)
     fname = f"users_{config.EVENT_CODE}.xlsx" if only_this else "users.xlsx"
     await bot.send_document(chat_id, BufferedInputFile(buf.getvalue(), filename=fname),
@@ -1,20 +1,21 @@
 # handlers/user.py
 from aiogram import Router, F
 import config
-import asyncio
 import json
 from aiogram.filters import CommandStart
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 
 from config import CHANNEL_ID, PAYMENT_LINK, INSTAGRAM_LINK
+import payment_expiry
+import broadcast
 from database import (
-    add_user,  get_row,
+    claim_draft_row, get_row,
     get_paid_status_by_id, set_paid_status_by_id,
     count_ticket_type_paid_for_event, count_ticket_type_for_event,
     log_one_plus_one_attempt, add_subscriber,
     get_one_plus_one_limit, remaining_one_plus_one_for_event,
-    set_meta, get_meta, set_ticket_type_by_id,
-    get_unique_one_plus_one_attempters_for_event, get_role_user_ids,
+    set_meta, get_meta,
+    get_role_user_ids,
 )
 
 router = Router()
@@ -110,9 +111,11 @@ async def back_from_reject(callback: CallbackQuery):
     else:
         await _show_ticket_menu(callback.bot, callback.from_user.id)
 
-async def _push_screen(bot, chat_id: int, text: str, kb: InlineKeyboardMarkup):
+async def _push_screen(bot, chat_id: int, text: str, kb: InlineKeyboardMarkup, limited: bool = False):
     """Удаляет предыдущий экран пользователя и отправляет новый.
-       НО не удаляет «защищённый» экран ожидания подтверждения."""
+       НО не удаляет «защищённый» экран ожидания подтверждения.
+       limited=True — массовая отправка: каждый вызов API под общим лимитом (broadcast.tg_call)."""
+    call = broadcast.tg_call if limited else (lambda factory: factory())
     protected_id_raw = await get_meta(f"review_msg:{chat_id}")  # храним id «ожидания»
     try:
         protected_id = int(protected_id_raw) if protected_id_raw else None
@@ -123,11 +126,11 @@ async def _push_screen(bot, chat_id: int, text: str, kb: InlineKeyboardMarkup):
     # удаляем предыдущий экран, только если он не «защищённый»
     if last_id and (protected_id is None or last_id != protected_id):
         try:
-            await bot.delete_message(chat_id, last_id)
+            await call(lambda: bot.delete_message(chat_id, last_id))
         except Exception:
             pass
 
-    sent = await bot.send_message(chat_id, text, reply_markup=kb)
+    sent = await call(lambda: bot.send_message(chat_id, text, reply_markup=kb))
     _LAST_MSG[chat_id] = sent.message_id
     return sent
 
@@ -138,41 +141,6 @@ async def _show_ticket_menu(bot, chat_id: int):
     kb = await _ticket_menu_kb()
     return await _push_screen(bot, chat_id, "Выбери тип билета:", kb)
 
-async def _notify_wishers_1p1_available(bot, event_code: str):
-    """
-    Шлём уведомления тем, кто пытался купить 1+1, когда слоты были заняты.
-    Отправляем не больше, чем текущий остаток по 1+1.
-    """
-    remaining = await remaining_one_plus_one_for_event(event_code)
-    if not remaining or remaining <= 0:
-        return
-
-    rows = await get_unique_one_plus_one_attempters_for_event(event_code)
-    if not rows:
-        return
-
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🎟 Оплатить билет", callback_data="ticket_1plus1")],
-        [InlineKeyboardButton(text="⬅️ Вернуться назад", callback_data="back:ticket")],
-    ])
-
-    sent = 0
-    for r in rows:
-        uid = int(r["user_id"])
-        try:
-            await bot.send_message(
-                uid,
-                f"✨ Освободились билеты 1+1 на «{event_code}». Успей забрать 👇",
-                reply_markup=kb
-            )
-            sent += 1
-        except Exception:
-            pass
-        if sent >= remaining:
-            break
-        await asyncio.sleep(0.05)  # мягкий rate limit
-
-
 # ————— Логика User —————
 
 # /start
@@ -223,18 +191,7 @@ async def ticket_menu(callback: CallbackQuery):
         )
         return
 
-    # создаём черновик покупки: paid="не оплатил", тип ещё не выбран
-    username = callback.from_user.username or "Без ника"
-    draft_row_id = await add_user(
-        user_id=callback.from_user.id,
-        username=username,
-        event_code=config.EVENT_CODE,
-        ticket_type="—"  # или "pending"
-    )
-    #  запомним id черновика для этого пользователя
-    await set_meta(f"draft_row:{callback.from_user.id}", str(draft_row_id))
-
-
+    # черновик покупки здесь не создаём — он появится при выборе билета (_present_payment)
     await _show_ticket_menu(callback.bot, callback.from_user.id)
 
 # Билет 1+1
@@ -430,31 +387,21 @@ async def _present_payment(obj, ticket_type: str, from_message: bool = False):
     user_id = user.id
     username = user.username or "Без ника"
 
-# пытаемся использовать черновик, созданный при "Оплатить билет"
-    draft_raw = await get_meta(f"draft_row:{user_id}")
-    row_id = None
-    if draft_raw:
+# черновик покупки: переиспользуем незавершённый на это мероприятие или создаём новый,
+# сразу со статусом "в процессе оплаты"
+    row_id, old_msg_id = await claim_draft_row(
+        user_id=user_id,
+        username=username,
+        event_code=config.EVENT_CODE,
+        ticket_type=ticket_type
+    )
+    bot = obj.bot
+    # черновик уже показывали — гасим кнопки на прежнем экране оплаты
+    if old_msg_id:
         try:
-            row_id = int(draft_raw)
+            await bot.edit_message_reply_markup(chat_id=user_id, message_id=old_msg_id, reply_markup=None)
         except Exception:
-            row_id = None
-
-    if row_id:
-    # проставляем выбранный тип в уже созданную запись
-        await set_ticket_type_by_id(row_id, ticket_type)
-    else:
-    # фолбэк: на всякий случай создадим новую (если меты нет)
-        row_id = await add_user(
-            user_id=user_id,
-            username=username,
-            event_code=config.EVENT_CODE,
-            ticket_type=ticket_type
-        )
-        await set_meta(f"draft_row:{user_id}", str(row_id))
-
-# пользователь начал оформление — статус "в процессе оплаты"
-    await set_paid_status_by_id(row_id, "в процессе оплаты")
-
+            pass
 
     # Человекочитаемое название для текста
     title_map = {"single": "1 билет", "1+1": "Билет 1+1"}
@@ -474,19 +421,10 @@ async def _present_payment(obj, ticket_type: str, from_message: bool = False):
         "Также можете оплатить переводом по СБП +79999257075 (ТБанк/Рокетбанк)"
     )
 
-    bot = obj.bot
     sent = await _push_screen(bot, user_id, text, _payment_kb(row_id))
 
-    # таймер 5 минут
-    asyncio.create_task(
-        _expire_payment_after(
-            bot=bot,
-            chat_id=user_id,
-            message_id=sent.message_id,
-            row_id=row_id,
-            timeout_sec=300
-        )
-    )
+    # таймер 5 минут — дедлайн в БД, снимает планировщик payment_expiry
+    await payment_expiry.schedule(row_id, sent.message_id)
 
 # Пользователь: «Я оплатил»
 @router.callback_query(F.data.startswith("paid_row:"))
@@ -561,39 +499,3 @@ async def help_command(message: Message):
         "ℹ️ Если возникли вопросы или проблемы, обратиcm к администратору:\n@stepanovvv13",
         _back_to_start_kb()
     )
-
-# Тайм-аут оплаты
-async def _expire_payment_after(bot, chat_id: int, message_id: int, row_id: int, timeout_sec: int = 300):
-    await asyncio.sleep(timeout_sec)
-
-    # узнаем тип билета и событие (важно для 1+1)
-    row = await get_row(row_id)
-    ticket_type = (row["ticket_type"] or "").strip().lower() if row else ""
-    event_code = row["event_code"] if row else None
-    
-    from database import get_paid_status_by_id
-    status = await get_paid_status_by_id(row_id)
-
-    if status in ("в процессе оплаты"):
-        # откатываем всё, что не "не оплатил", в "не оплатил"
-        if status != "не оплатил":
-            try:
-                await set_paid_status_by_id(row_id, "не оплатил")
-            except Exception:
-                pass        
-        try:
-            await bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=None)
-        except Exception:
-            pass
-
-        # показываем уведомление + то же меню выбора билета
-        kb = await _ticket_menu_kb()
-        await _push_screen(
-            bot, chat_id,
-            "⏰ Время оплаты истекло.\nВыберите тип билета заново:",
-            kb
-        )
-        
-        # если освободился слот 1+1 — предупредим желающих
-        if ticket_type == "1+1" and event_code:
-            await _notify_wishers_1p1_available(bot, event_code)
@@ -1,5 +1,6 @@
-from database import metadata, engine, users  # Обязательно импортируй таблицу!
+from migrations import run_migrations
 
 if __name__ == "__main__":
-    metadata.create_all(engine, checkfirst=True)
-    print("✅ Таблица users создана.")
+    # Таблицы, одноразовая карта старых QR и индексы — всё через версионированные миграции
+    versions = run_migrations()
+    print(f"✅ Схема БД актуальна. Применены миграции: {versions or 'нет новых'}")
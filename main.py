@@ -1,4 +1,9 @@
 import os
+import hmac
+import hashlib
+import json
+import time
+from urllib.parse import parse_qsl, urlsplit
 from aiohttp import web, ClientSession
 import asyncio
 from aiogram import Bot, Dispatcher, F
@@ -6,8 +11,13 @@ from aiogram.types import BotCommand, Message
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from aiogram.exceptions import TelegramNetworkError, TelegramBadRequest
 from aiogram.types.error_event import ErrorEvent
-from config import BOT_TOKEN, WEBHOOK_URL
-from database import connect_db, disconnect_db, get_status, update_status, get_status_by_id, update_status_by_id, get_row, get_ticket_type
+import config
+from config import BOT_TOKEN, WEBHOOK_URL, SCAN_WEBAPP_URL, SCAN_AUTH_MAX_AGE, SCAN_BATCH_MAX
+from database import connect_db, disconnect_db, db_stats, has_any_role, rebuild_ticket_counters, load_roles, compact_abandoned_drafts, CHECKIN_ACTIVATED, CHECKIN_NOT_FOUND
+import ticket_index
+import payment_expiry
+import broadcast_jobs
+from qr_generator import parse_payload, render_stats, shutdown_render_pool, PAYLOAD_SIGNED, PAYLOAD_LEGACY, PAYLOAD_OTHER_EVENT
 from handlers import user, admin
 # duplicate import removed
 WEBHOOK_PATH = "/webhook"
@@ -19,7 +29,8 @@ dp = Dispatcher()
 
 # /start <payload> — deep-link обработчик
 # Поддерживаем:
-#   - "R:<row_id>"
+#   - "T1_<row_id>_…_<sig>" (подписанный QR)
+#   - "<число>", "R:<row_id>" (старые QR)
 async def deep_link_start_handler(message: Message):
     parts = message.text.split(maxsplit=1)
     if len(parts) != 2:
@@ -30,42 +41,24 @@ async def deep_link_start_handler(message: Message):
         await message.answer("❌ Недопустимый QR-код.")
         return
 
-    # Совместимый парсинг: убираем префиксы и «хвост» после двоеточия
-    p = payload
-    if p.lower().startswith("qr:"):
-        p = p[3:].lstrip()
-    if p.lower().startswith("r:"):
-        p = p[2:].lstrip()
-    num_str = p.split(":", 1)[0]
-
-    try:
-        candidate = int(num_str)
-    except ValueError:
-        await message.answer("❌ Недопустимый QR-код.")
+    # Подпись и мероприятие проверяем локально — до любого запроса к БД
+    kind, candidate, _signed_type = parse_payload(payload, config.EVENT_CODE)
+    if kind == PAYLOAD_OTHER_EVENT:
+        await message.answer("❌ Этот QR-код от другого мероприятия.")
         return
-
-    # 1) СТАРЫЙ QR: число = user_id (берём последнюю покупку пользователя)
-    status = await get_status(candidate)
-    if status is not None:
-        ticket_type = await get_ticket_type(candidate) or "-"
-        if status == "не активирован":
-            await update_status(candidate, "активирован")
-            await message.answer(f"✅ Пропуск активирован.\nТип билета: {ticket_type}")
-        else:
-            await message.answer(f"⚠️ Этот QR-код уже использован.\nТип билета: {ticket_type}")
+    if kind not in (PAYLOAD_SIGNED, PAYLOAD_LEGACY):
+        await message.answer("❌ Недопустимый QR-код.")
         return
 
-    # 2) НОВЫЙ QR: число = row_id (одна строка = один билет)
-    row = await get_row(candidate)
-    if row is None:
+    # Подписанный QR — это точно row_id; голое число — старый QR (user_id или row_id).
+    # Индекс в памяти, в БД — только активация
+    result, row = await ticket_index.checkin(candidate, legacy=(kind == PAYLOAD_LEGACY))
+    if result == CHECKIN_NOT_FOUND:
         await message.answer("❌ QR-код не найден.")
         return
 
     ticket_type = row["ticket_type"] or "-"
-    status_by_id = row["status"]  # можно и await get_status_by_id(candidate)
-
-    if status_by_id == "не активирован":
-        await update_status_by_id(candidate, "активирован")
+    if result == CHECKIN_ACTIVATED:
         await message.answer(f"✅ Пропуск активирован.\nТип билета: {ticket_type}")
     else:
         await message.answer(f"⚠️ Этот QR-код уже использован.\nТип билета: {ticket_type}")
@@ -144,9 +137,64 @@ async def _set_webhook_background():
             else:
                 print("[ERROR] Unable to set webhook after retries", flush=True)
 
+async def _reconcile_counters_loop():
+    """Периодическая сверка инкрементальных счётчиков продаж с таблицей users."""
+    while True:
+        await asyncio.sleep(config.COUNTERS_RECONCILE_SEC)
+        try:
+            await rebuild_ticket_counters()
+            print("[COUNTERS] Reconciled ticket_counters", flush=True)
+        except Exception as e:
+            print(f"[WARN] ticket_counters reconcile failed: {e}", flush=True)
+
+async def _compact_drafts_loop():
+    """Периодически удаляем брошенные черновики покупок (см. compact_abandoned_drafts)."""
+    while True:
+        await asyncio.sleep(config.DRAFT_COMPACT_SEC)
+        try:
+            n = await compact_abandoned_drafts(config.DRAFT_TTL_HOURS)
+            if n:
+                print(f"[DRAFTS] Removed {n} abandoned drafts", flush=True)
+        except Exception as e:
+            print(f"[WARN] draft compaction failed: {e}", flush=True)
+
+async def _reload_roles_loop():
+    """Периодически перечитываем роли — подхватываем изменения, сделанные в обход бота."""
+    while True:
+        await asyncio.sleep(config.ROLES_RELOAD_SEC)
+        try:
+            await load_roles()
+        except Exception as e:
+            print(f"[WARN] roles reload failed: {e}", flush=True)
+
 async def on_startup(app: web.Application):
-    # Если подлючение к БД может быть долгим — тоже можно вынести в фон:
+    # Миграции схемы (индексы CONCURRENTLY, без блокировок) — синхронный движок, в отдельном потоке;
+    # пока они идут, параллельно открываем и прогреваем асинхронный пул
+    migrations_task = None
+    if config.RUN_MIGRATIONS_ON_STARTUP:
+        from migrations import run_migrations
+        migrations_task = asyncio.create_task(asyncio.to_thread(run_migrations))
     await connect_db()
+    if migrations_task is not None:
+        try:
+            applied = await migrations_task
+            if applied:
+                print(f"[INIT] Migrations applied: {applied}", flush=True)
+        except Exception as e:
+            # не стартуем на схеме, которую код не ожидает
+            print(f"[ERROR] migrations failed: {e}", flush=True)
+            raise
+    # Роли в памяти — проверки прав без запросов к БД
+    try:
+        n = await load_roles()
+        print(f"[INIT] Roles loaded for {n} users", flush=True)
+    except Exception as e:
+        print(f"[WARN] load_roles: {e}", flush=True)
+    # Индекс билетов текущего мероприятия для быстрого прохода
+    try:
+        await ticket_index.load(config.EVENT_CODE)
+    except Exception as e:
+        print(f"[WARN] ticket_index.load: {e}", flush=True)
     # Команды можно выставить быстро
     try:
         await bot.set_my_commands([
@@ -166,6 +214,16 @@ async def on_startup(app: web.Application):
         print(f"[WARN] get_me failed: {e}", flush=True)
     print(f"[INIT] WEBHOOK_URL base: '{WEBHOOK_URL}' | FULL: '{FULL_WEBHOOK_URL}'", flush=True)
     asyncio.create_task(_set_webhook_background())
+    if config.COUNTERS_RECONCILE_SEC > 0:
+        asyncio.create_task(_reconcile_counters_loop())
+    if config.ROLES_RELOAD_SEC > 0:
+        asyncio.create_task(_reload_roles_loop())
+    if config.DRAFT_COMPACT_SEC > 0:
+        asyncio.create_task(_compact_drafts_loop())
+    # Истечение окна оплаты (дедлайны в БД — подхватываем и те, что «проспали» при рестарте)
+    asyncio.create_task(payment_expiry.run(bot))
+    # Задания рассылок: продолжаем прерванные рестартом с сохранённого курсора
+    asyncio.create_task(broadcast_jobs.run(bot))
     print("✅ Startup finished (server will bind now)", flush=True)
 
 async def on_shutdown(app: web.Application):
@@ -174,6 +232,7 @@ async def on_shutdown(app: web.Application):
         await disconnect_db()
     except Exception:
         pass
+    shutdown_render_pool()
 
 async def healthcheck(request):
     return web.Response(text="OK")
@@ -202,6 +261,8 @@ async def diag(request):
                 "ip_address": getattr(info, "ip_address", None),
                 "last_error_message": getattr(info, "last_error_message", None),
             },
+            "qr_render": render_stats(),
+            "db": db_stats(),
         }
     except Exception as e:
         return web.json_response({"error": str(e)}, status=500)
@@ -219,6 +280,83 @@ async def set_webhook_raw(request):
     except Exception as e:
         return web.json_response({"error": str(e)}, status=500)
 
+# =========================
+# Пакетный приём сканов от WebApp-сканера
+# POST /scan/batch  {"init_data": "<Telegram.WebApp.initData>", "codes": ["T1_…", "123", …]}
+# (initData можно передать и заголовком X-Telegram-Init-Data)
+# Ответ: {"results": [{"code", "result", "ticket_type"}, …]} в порядке codes
+# =========================
+def _verify_init_data(init_data: str) -> int | None:
+    """Проверка подписи Telegram WebApp initData. Возвращает user_id или None."""
+    try:
+        fields = dict(parse_qsl(init_data or "", strict_parsing=True))
+    except ValueError:
+        return None
+    received_hash = fields.pop("hash", "")
+    if not received_hash:
+        return None
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", BOT_TOKEN.encode("utf-8"), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode("utf-8"), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected.encode("utf-8"), received_hash.encode("utf-8")):
+        return None
+    try:
+        if time.time() - int(fields.get("auth_date", "0")) > SCAN_AUTH_MAX_AGE:
+            return None
+        return int(json.loads(fields["user"])["id"])
+    except Exception:
+        return None
+
+def _cors_headers() -> dict:
+    if not SCAN_WEBAPP_URL:
+        return {}
+    parts = urlsplit(SCAN_WEBAPP_URL)
+    return {
+        "Access-Control-Allow-Origin": f"{parts.scheme}://{parts.netloc}",
+        "Access-Control-Allow-Methods": "POST, OPTIONS",
+        "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Init-Data",
+    }
+
+async def scan_batch_options(request):
+    return web.Response(headers=_cors_headers())
+
+async def scan_batch(request):
+    headers = _cors_headers()
+    try:
+        body = await request.json()
+    except Exception:
+        return web.json_response({"error": "bad json"}, status=400, headers=headers)
+    if not isinstance(body, dict):
+        return web.json_response({"error": "bad json"}, status=400, headers=headers)
+
+    uid = _verify_init_data(request.headers.get("X-Telegram-Init-Data") or body.get("init_data") or "")
+    if uid is None:
+        return web.json_response({"error": "unauthorized"}, status=401, headers=headers)
+    if not await has_any_role(uid, ("admin", "scanner")):
+        return web.json_response({"error": "forbidden"}, status=403, headers=headers)
+
+    codes = body.get("codes")
+    if not isinstance(codes, list) or len(codes) > SCAN_BATCH_MAX:
+        return web.json_response({"error": f"codes must be a list of at most {SCAN_BATCH_MAX}"}, status=400, headers=headers)
+
+    # Подпись/мероприятие проверяем локально, в БД уходят только валидные коды
+    results: list[dict] = []
+    items: list[tuple[int, bool]] = []
+    pending: list[int] = []   # индексы results, ждущие ответа из БД
+    for code in codes:
+        code = str(code)
+        kind, candidate, _signed_type = parse_payload(code, config.EVENT_CODE)
+        results.append({"code": code, "result": kind, "ticket_type": None})
+        if kind in (PAYLOAD_SIGNED, PAYLOAD_LEGACY):
+            items.append((candidate, kind == PAYLOAD_LEGACY))
+            pending.append(len(results) - 1)
+
+    for i, (result, row) in zip(pending, await ticket_index.checkin_many(items)):
+        results[i]["result"] = result
+        results[i]["ticket_type"] = row["ticket_type"] if row else None
+
+    return web.json_response({"results": results}, headers=headers)
+
 def create_app():
     app = web.Application(middlewares=[request_logger])
     app.on_startup.append(on_startup)
@@ -229,6 +367,8 @@ def create_app():
     app.router.add_get("/set-webhook", set_webhook_now)
     app.router.add_get("/set-webhook-raw", set_webhook_raw)
     app.router.add_get("/diag", diag)
+    app.router.add_post("/scan/batch", scan_batch)
+    app.router.add_route("OPTIONS", "/scan/batch", scan_batch_options)
     return app
 
 @web.middleware
@@ -0,0 +1,277 @@
+# migrations.py
+# Версионированные миграции схемы. Применённые версии пишем в schema_migrations.
+# Индексы строим CREATE INDEX CONCURRENTLY (без блокировки записи), поэтому
+# соединение работает в AUTOCOMMIT, а параллельный запуск нескольких инстансов
+# разводим через pg_advisory_lock.
+#
+#   python migrations.py        — применить всё, что ещё не применено
+#   (и автоматически на старте бота, см. main.on_startup)
+from sqlalchemy import text
+
+from database import (
+    get_sync_engine,
+    LEGACY_QR_MAP_BUILD_SQL, EVENT_PRICES_BACKFILL_SQL, TICKET_COUNTERS_REBUILD_SQL,
+)
+
+_LOCK_KEY = 727_001  # произвольный ключ advisory-lock для миграций
+
+
+def _index(name: str, ddl: str) -> list[str]:
+    # Недостроенный CONCURRENTLY-индекс остаётся INVALID — пересоздаём с нуля
+    return [f"DROP INDEX CONCURRENTLY IF EXISTS {name}", ddl]
+
+
+def _fill_ticket_counters(conn):
+    # LOCK работает только внутри транзакции, а conn у нас в AUTOCOMMIT —
+    # берём отдельное соединение; при ошибке транзакция откатится целиком
+    with conn.engine.begin() as tx:
+        tx.execute(text("LOCK TABLE ticket_counters IN EXCLUSIVE MODE"))
+        tx.execute(text("DELETE FROM ticket_counters"))
+        tx.execute(text(TICKET_COUNTERS_REBUILD_SQL))
+
+
+# (версия, название, шаги) — шаг это SQL-строка или функция(conn).
+# Таблицы создаём явным DDL, а не metadata.create_all: схема версии не должна
+# зависеть от текущих Table() в database.py (новые колонки — отдельными миграциями).
+MIGRATIONS = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            username VARCHAR,
+            event_code VARCHAR,
+            ticket_type VARCHAR,
+            paid VARCHAR,
+            status VARCHAR,
+            purchase_date DATE DEFAULT CURRENT_DATE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_users_user_id ON users (user_id)",
+        """
+        CREATE TABLE IF NOT EXISTS one_plus_one_attempts (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            username VARCHAR,
+            event_code VARCHAR NOT NULL,
+            attempted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS roles (
+            user_id BIGINT NOT NULL,
+            role VARCHAR NOT NULL,
+            granted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS subscribers (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR,
+            last_seen_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bot_meta (
+            key VARCHAR PRIMARY KEY,
+            value VARCHAR
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS one_plus_one_limits (
+            event_code VARCHAR PRIMARY KEY,
+            limit_qty INTEGER NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+    ]),
+    (2, "legacy qr map", [
+        """
+        CREATE TABLE IF NOT EXISTS legacy_qr_map (
+            user_id BIGINT PRIMARY KEY,
+            row_id INTEGER NOT NULL
+        )
+        """,
+        LEGACY_QR_MAP_BUILD_SQL,
+    ]),
+    (3, "users: event/type/paid", _index(
+        "ix_users_event_type_paid",
+        "CREATE INDEX CONCURRENTLY ix_users_event_type_paid ON users (event_code, ticket_type, paid)",
+    )),
+    (4, "users: event + id", _index(
+        "ix_users_event_id",
+        "CREATE INDEX CONCURRENTLY ix_users_event_id ON users (event_code, id DESC)",
+    )),
+    (5, "users: paid tickets per event", _index(
+        "ix_users_paid_event",
+        "CREATE INDEX CONCURRENTLY ix_users_paid_event ON users (event_code, id) WHERE paid = 'оплатил'",
+    )),
+    (6, "users: activated", _index(
+        "ix_users_activated",
+        "CREATE INDEX CONCURRENTLY ix_users_activated ON users (event_code) WHERE status = 'активирован'",
+    )),
+    (7, "1+1 attempts: event + user", _index(
+        "ix_one_plus_one_attempts_event_user",
+        "CREATE INDEX CONCURRENTLY ix_one_plus_one_attempts_event_user "
+        "ON one_plus_one_attempts (event_code, user_id, attempted_at)",
+    )),
+    (8, "roles: unique (user_id, role)", [
+        # убираем дубли, иначе уникальный индекс не построится
+        """
+        DELETE FROM roles a
+        USING roles b
+        WHERE a.user_id = b.user_id AND a.role = b.role AND a.ctid > b.ctid
+        """,
+        *_index(
+            "uq_roles_user_role",
+            "CREATE UNIQUE INDEX CONCURRENTLY uq_roles_user_role ON roles (user_id, role)",
+        ),
+    ]),
+    (9, "event prices table", [
+        """
+        CREATE TABLE IF NOT EXISTS event_prices (
+            event_code VARCHAR NOT NULL,
+            ticket_type VARCHAR NOT NULL,
+            price INTEGER NOT NULL,
+            PRIMARY KEY (event_code, ticket_type)
+        )
+        """,
+        EVENT_PRICES_BACKFILL_SQL,
+    ]),
+    (10, "ticket counters", [
+        """
+        CREATE TABLE IF NOT EXISTS ticket_counters (
+            event_code VARCHAR NOT NULL,
+            ticket_type VARCHAR NOT NULL,
+            paid VARCHAR NOT NULL,
+            qty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (event_code, ticket_type, paid)
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION ticket_counters_sync() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE ticket_counters
+                   SET qty = qty - 1
+                 WHERE event_code = COALESCE(OLD.event_code, '—')
+                   AND ticket_type = COALESCE(OLD.ticket_type, '—')
+                   AND paid = COALESCE(OLD.paid, '—');
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO ticket_counters(event_code, ticket_type, paid, qty)
+                VALUES (COALESCE(NEW.event_code, '—'), COALESCE(NEW.ticket_type, '—'),
+                        COALESCE(NEW.paid, '—'), 1)
+                ON CONFLICT (event_code, ticket_type, paid) DO UPDATE
+                   SET qty = ticket_counters.qty + 1;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS trg_users_counters_ins_del ON users",
+        """
+        CREATE TRIGGER trg_users_counters_ins_del
+        AFTER INSERT OR DELETE ON users
+        FOR EACH ROW EXECUTE FUNCTION ticket_counters_sync()
+        """,
+        "DROP TRIGGER IF EXISTS trg_users_counters_upd ON users",
+        """
+        CREATE TRIGGER trg_users_counters_upd
+        AFTER UPDATE OF event_code, ticket_type, paid ON users
+        FOR EACH ROW
+        WHEN (OLD.event_code IS DISTINCT FROM NEW.event_code
+              OR OLD.ticket_type IS DISTINCT FROM NEW.ticket_type
+              OR OLD.paid IS DISTINCT FROM NEW.paid)
+        EXECUTE FUNCTION ticket_counters_sync()
+        """,
+        _fill_ticket_counters,
+    ]),
+    (11, "users: latest row per user", _index(
+        "ix_users_user_id_id",
+        "CREATE INDEX CONCURRENTLY ix_users_user_id_id ON users (user_id, id DESC)",
+    )),
+    # без DEFAULT в ADD COLUMN — таблица не переписывается; у старых строк created_at = NULL
+    (12, "users: created_at", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ",
+        "ALTER TABLE users ALTER COLUMN created_at SET DEFAULT NOW()",
+        # черновики больше не запоминаются в bot_meta
+        "DELETE FROM bot_meta WHERE key LIKE 'draft_row:%'",
+    ]),
+    (13, "users: payment deadline", [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS pay_deadline TIMESTAMPTZ",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS pay_msg_id BIGINT",
+        *_index(
+            "ix_users_pay_deadline",
+            "CREATE INDEX CONCURRENTLY ix_users_pay_deadline ON users (pay_deadline) "
+            "WHERE pay_deadline IS NOT NULL",
+        ),
+    ]),
+    (14, "broadcast jobs", [
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            kind VARCHAR NOT NULL,
+            spec VARCHAR NOT NULL,
+            status VARCHAR NOT NULL DEFAULT 'running',
+            cursor BIGINT NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            total INTEGER,
+            reply_chat_id BIGINT,
+            progress_msg_id BIGINT,
+            locked_until TIMESTAMPTZ,
+            lease_token VARCHAR,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL,
+            user_id BIGINT NOT NULL,
+            outcome VARCHAR NOT NULL,
+            PRIMARY KEY (job_id, user_id)
+        )
+        """,
+    ]),
+]
+
+
+def run_migrations() -> list[int]:
+    """Применяет недостающие миграции по порядку. Возвращает применённые версии."""
+    applied_now = []
+    with get_sync_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": _LOCK_KEY})
+        try:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+            """))
+            done = {r[0] for r in conn.execute(text("SELECT version FROM schema_migrations"))}
+            for version, name, steps in MIGRATIONS:
+                if version in done:
+                    continue
+                print(f"[MIGRATE] {version}: {name}", flush=True)
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(text(step))
+                conn.execute(
+                    text("INSERT INTO schema_migrations(version, name) VALUES (:v, :n)"),
+                    {"v": version, "n": name},
+                )
+                applied_now.append(version)
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _LOCK_KEY})
+    return applied_now
+
+
+if __name__ == "__main__":
+    versions = run_migrations()
+    print(f"✅ Миграции применены: {versions or 'нечего применять'}")
@@ -0,0 +1,128 @@
+# payment_expiry.py
+# Истечение окна оплаты и освобождение слотов 1+1 — единственное место этой логики.
+# Дедлайн хранится в строке покупки (users.pay_deadline), поэтому таймеры переживают
+# рестарт/деплой. Один цикл на процесс: спит до ближайшего дедлайна, снимает все
+# наступившие одним UPDATE ... RETURNING, затем пачкой шлёт «время вышло» и, если
+# освободились 1+1, уведомляет желающих — через broadcast (параллельно, под общим rate limit).
+#
+#   schedule(row_id, message_id)  — поставить/перезапустить таймер (экран оплаты, отклонение)
+#   release_1p1(bot, events)      — уведомить желающих 1+1 об освободившихся слотах
+#   run(bot)                      — фоновый цикл (main.on_startup)
+import asyncio
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+import config
+import broadcast
+import ticket_index
+from database import (
+    set_payment_deadline, seconds_to_next_payment_deadline, expire_due_payments,
+    remaining_one_plus_one_for_event, get_unique_one_plus_one_attempters_for_event,
+)
+
+_wake = asyncio.Event()
+
+
+async def schedule(row_id: int, message_id: int | None, timeout_sec: int | None = None):
+    """Запомнить дедлайн оплаты для строки и разбудить цикл (если он спит дольше)."""
+    await set_payment_deadline(row_id, timeout_sec or config.PAYMENT_TIMEOUT_SEC, message_id)
+    _wake.set()
+
+
+async def _notify_expired(bot, rows):
+    # Хелперы экранов живут в хендлерах; импортируем лениво — хендлеры сами импортируют schedule
+    from handlers import user as user_h
+
+    kb = await user_h._ticket_menu_kb()   # один раз на пачку (лимит 1+1 читаем однократно)
+
+    # у пользователя может истечь несколько покупок сразу — гасим кнопки на каждом экране оплаты,
+    # а «время вышло» шлём один раз
+    by_chat: dict[int, list[int]] = {}
+    for r in rows:
+        msg_ids = by_chat.setdefault(r["user_id"], [])
+        if r["pay_msg_id"]:
+            msg_ids.append(r["pay_msg_id"])
+
+    async def one(chat_id):
+        for msg_id in by_chat[chat_id]:
+            try:
+                await broadcast.tg_call(
+                    lambda: bot.edit_message_reply_markup(chat_id=chat_id, message_id=msg_id, reply_markup=None)
+                )
+            except Exception:
+                pass
+        # удаление прошлого экрана и отправка — каждый вызов берёт свой токен
+        await user_h._push_screen(
+            bot, chat_id, "⏰ Время оплаты истекло.\nВыберите тип билета заново:", kb, limited=True
+        )
+
+    await broadcast.run(list(by_chat), one)
+
+
+async def release_1p1(bot, event_codes):
+    """
+    Освободились слоты 1+1 — предупредить желающих (кто пытался купить при закрытом лимите).
+    На мероприятие: остаток и список желающих читаем один раз, шлём параллельно под rate limit,
+    не больше остатка успешных уведомлений.
+    """
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🎟 Оплатить билет", callback_data="ticket_1plus1")],
+        [InlineKeyboardButton(text="⬅️ Вернуться назад", callback_data="back:ticket")],
+    ])
+    for event_code in event_codes:
+        remaining = await remaining_one_plus_one_for_event(event_code)
+        if not remaining or remaining <= 0:
+            continue
+        uids = [int(r["user_id"]) for r in await get_unique_one_plus_one_attempters_for_event(event_code)]
+        text = f"✨ Освободились билеты 1+1 на «{event_code}». Успей забрать 👇"
+
+        # волнами: недоставленные (заблокировали бота и т.п.) добираем следующими по списку
+        sent = 0
+        while uids and sent < remaining:
+            wave, uids = uids[:remaining - sent], uids[remaining - sent:]
+            stats = await broadcast.run(
+                wave, lambda uid: broadcast.tg_call(lambda: bot.send_message(uid, text, reply_markup=kb))
+            )
+            sent += stats["sent"]
+
+
+async def _expire_once(bot) -> int:
+    rows = await expire_due_payments()
+    # «на проверке» / «оплатил» — таймер просто погашен, пользователю ничего не шлём
+    expired = [r for r in rows if r["old_paid"] in ("в процессе оплаты", "отклонено")]
+    for r in expired:
+        ticket_index.remove(r["id"])
+    if expired:
+        try:
+            await _notify_expired(bot, expired)
+        except Exception as e:
+            print(f"[WARN] payment expiry notices failed: {e}", flush=True)
+        freed = {
+            r["event_code"] for r in expired
+            if (r["ticket_type"] or "").strip().lower() == "1+1" and r["event_code"]
+        }
+        if freed:
+            try:
+                await release_1p1(bot, freed)
+            except Exception as e:
+                print(f"[WARN] 1+1 release notices failed: {e}", flush=True)
+    return len(rows)
+
+
+async def run(bot):
+    """Фоновый цикл: ждём ближайший дедлайн (не дольше PAYMENT_EXPIRY_MAX_SLEEP) или schedule()."""
+    while True:
+        _wake.clear()
+        try:
+            while await _expire_once(bot):
+                pass
+            delay = await seconds_to_next_payment_deadline()
+        except Exception as e:
+            print(f"[WARN] payment expiry loop: {e}", flush=True)
+            delay = None
+        # не чаще раза в секунду: наступивший дедлайн может держать другой инстанс (SKIP LOCKED)
+        sleep = config.PAYMENT_EXPIRY_MAX_SLEEP if delay is None else min(max(delay, 1.0), config.PAYMENT_EXPIRY_MAX_SLEEP)
+        try:
+            await asyncio.wait_for(_wake.wait(), timeout=sleep)
+        except asyncio.TimeoutError:
+            pass
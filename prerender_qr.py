@@ -0,0 +1,147 @@
+# prerender_qr.py
+# Массовый пре-рендер QR всех оплаченных билетов мероприятия в постоянный кэш (QR_CACHE_DIR),
+# плюс выгрузка в ZIP и печатный многостраничный PDF для офлайн-списков на входе.
+#
+# CLI:  python prerender_qr.py <event_code> [--zip tickets.zip] [--pdf sheet.pdf]
+# Бот:  /prerender_qr (админ) — для текущего мероприятия
+import argparse
+import asyncio
+import zipfile
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from database import connect_db, disconnect_db, iter_paid_rows_for_event, get_meta, set_meta
+from config import QR_CACHE_DIR
+from qr_generator import generate_qr, is_qr_cached, QR_PAYLOAD_VERSION
+
+_BATCH = 32   # сколько билетов рендерим параллельно (дальше ограничивает пул qr_generator)
+
+
+def _checkpoint_key(event_code: str) -> str:
+    return f"qr_prerender:{QR_PAYLOAD_VERSION}:{event_code}"
+
+
+async def prerender_event(event_code: str, progress=None) -> tuple[int, int]:
+    """
+    Рендерит QR всех оплаченных билетов мероприятия в кэш.
+    Продолжает с последнего сохранённого row_id (чекпоинт в bot_meta), уже готовые файлы пропускает.
+    progress(done, rendered) — необязательный async-колбэк после каждой порции.
+    Возвращает (обработано, отрисовано).
+    """
+    if not QR_CACHE_DIR:
+        # без каталога кэш живёт только в памяти процесса — пре-рендер был бы впустую
+        raise RuntimeError("QR_CACHE_DIR не задан: пре-рендеру некуда сохранять QR")
+    raw = await get_meta(_checkpoint_key(event_code))
+    after_id = int(raw) if raw and raw.isdigit() else 0
+
+    done = rendered = 0
+    batch = []
+
+    async def flush():
+        nonlocal done, rendered
+        todo = [r for r in batch if not is_qr_cached(r["id"], event_code, r["ticket_type"])]
+        await asyncio.gather(*(
+            generate_qr(r["id"], event_code, r["ticket_type"], remember=False, wait=True) for r in todo
+        ))
+        done += len(batch)
+        rendered += len(todo)
+        await set_meta(_checkpoint_key(event_code), str(batch[-1]["id"]))
+        batch.clear()
+        if progress:
+            await progress(done, rendered)
+
+    async for r in iter_paid_rows_for_event(event_code, after_id=after_id):
+        batch.append(r)
+        if len(batch) >= _BATCH:
+            await flush()
+    if batch:
+        await flush()
+
+    # прошли до конца — следующий запуск снова проверит всё (новые оплаты)
+    await set_meta(_checkpoint_key(event_code), "")
+    return done, rendered
+
+
+def _page_layout():
+    # A4 @150dpi, сетка 3x4, 1-битные страницы — компактно и для печати
+    page_w, page_h, cols, rows_n, margin = 1240, 1754, 3, 4, 60
+    cell_w = (page_w - 2 * margin) // cols
+    cell_h = (page_h - 2 * margin) // rows_n
+    return page_w, page_h, cols, rows_n, margin, cell_w, cell_h
+
+
+def _append_pdf_page(path: str, items: list[tuple[dict, bytes]], event_code: str, start: int, first: bool):
+    page_w, page_h, cols, _rows_n, margin, cell_w, cell_h = _page_layout()
+    qr_side = min(cell_w, cell_h - 60) - 20
+
+    page = Image.new("1", (page_w, page_h), 1)
+    draw = ImageDraw.Draw(page)
+    draw.text((margin, margin // 3), f"{event_code} — {start + 1}…{start + len(items)}", fill=0)
+    for i, (r, png) in enumerate(items):
+        x = margin + (i % cols) * cell_w
+        y = margin + (i // cols) * cell_h
+        qr = Image.open(BytesIO(png)).convert("1").resize((qr_side, qr_side), Image.NEAREST)
+        page.paste(qr, (x + (cell_w - qr_side) // 2, y))
+        caption = f"№{r['id']} · {r['ticket_type'] or '-'} · @{r['username'] or '-'}"
+        draw.text((x + 10, y + qr_side + 10), caption, fill=0)
+    # страница дописывается в конец файла — в памяти не больше одной страницы
+    page.save(path, format="PDF", append=not first, resolution=150)
+
+
+async def build_zip(event_code: str, path: str) -> int:
+    """ZIP с PNG всех оплаченных билетов в файл path, по одному билету за раз. Возвращает число билетов."""
+    n = 0
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as zf:   # PNG уже сжат
+        async for r in iter_paid_rows_for_event(event_code):
+            png = await generate_qr(r["id"], event_code, r["ticket_type"], remember=False, wait=True)
+            zf.writestr(f"ticket_{r['id']}.png", png)
+            n += 1
+    return n
+
+
+async def build_sheet_pdf(event_code: str, path: str) -> int:
+    """Печатный лист (PDF) в файл path, постранично. Возвращает число билетов (0 — файл не создан)."""
+    _page_w, _page_h, cols, rows_n, *_ = _page_layout()
+    per_page = cols * rows_n
+    n = 0
+    chunk: list[tuple[dict, bytes]] = []
+    async for r in iter_paid_rows_for_event(event_code):
+        png = await generate_qr(r["id"], event_code, r["ticket_type"], remember=False, wait=True)
+        chunk.append((dict(r), png))
+        if len(chunk) == per_page:
+            await asyncio.to_thread(_append_pdf_page, path, chunk, event_code, n, n == 0)
+            n += len(chunk)
+            chunk = []
+    if chunk:
+        await asyncio.to_thread(_append_pdf_page, path, chunk, event_code, n, n == 0)
+        n += len(chunk)
+    return n
+
+
+async def _main():
+    ap = argparse.ArgumentParser(description="Пре-рендер QR-билетов мероприятия")
+    ap.add_argument("event_code")
+    ap.add_argument("--zip", dest="zip_path", help="записать PNG всех билетов в ZIP")
+    ap.add_argument("--pdf", dest="pdf_path", help="записать печатный лист (PDF)")
+    args = ap.parse_args()
+
+    async def progress(done, rendered):
+        print(f"\r[QR] обработано: {done}, отрисовано: {rendered}", end="", flush=True)
+
+    await connect_db()
+    try:
+        done, rendered = await prerender_event(args.event_code, progress)
+        print(f"\n✅ Готово: {done} билетов, новых QR: {rendered}")
+        if args.zip_path:
+            await build_zip(args.event_code, args.zip_path)
+            print(f"📦 ZIP: {args.zip_path}")
+        if args.pdf_path:
+            await build_sheet_pdf(args.event_code, args.pdf_path)
+            print(f"🖨 PDF: {args.pdf_path}")
+    finally:
+        await disconnect_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -1,14 +1,286 @@
 # qr_generator.py
+import asyncio
+import hashlib
+import hmac
+import os
+import time
 import qrcode
+import qrcode.constants
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from io import BytesIO
 
-async def generate_qr(row_id: int) -> bytes:
+from qrcode.exceptions import DataOverflowError
+
+from config import (
+    QR_SECRET, QR_CACHE_SIZE, QR_CACHE_DIR,
+    QR_RENDER_MODE, QR_RENDER_WORKERS, QR_RENDER_QUEUE,
+    QR_ERROR_CORRECTION, QR_BOX_SIZE, QR_BORDER, QR_VERSION,
+)
+
+# Формат подписанного QR (v1), только [A-Za-z0-9_] — подходит для ?start=<payload>:
+#   T1_<row_id>_<event_tag>_<type>_<sig>
+#   event_tag — 6 hex от sha256(event_code), type — d (1+1) / s (single) / p (промокод),
+#   sig — первые 16 hex HMAC-SHA256(QR_SECRET, "T1_<row_id>_<event_tag>_<type>")
+QR_PAYLOAD_VERSION = "T1"
+_SIG_LEN = 16
+
+# Результаты разбора payload
+PAYLOAD_SIGNED = "signed"        # подпись верна, мероприятие текущее — число это row_id
+PAYLOAD_LEGACY = "legacy"        # старый QR: голое число (user_id или row_id)
+PAYLOAD_FORGED = "forged"        # подпись не сошлась
+PAYLOAD_OTHER_EVENT = "other_event"
+PAYLOAD_INVALID = "invalid"
+
+_TYPE_CODES = {"1+1": "d", "single": "s"}
+_TYPE_NAMES = {"d": "1+1", "s": "single", "p": "promocode"}
+
+
+def _event_tag(event_code: str) -> str:
+    return hashlib.sha256((event_code or "").encode("utf-8")).hexdigest()[:6]
+
+
+def _sign(body: str) -> str:
+    return hmac.new(QR_SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).hexdigest()[:_SIG_LEN]
+
+
+def make_payload(row_id: int, event_code: str | None = None, ticket_type: str | None = None) -> str:
+    """
+    Полезная нагрузка QR. Без event_code — старый формат (только row_id),
+    иначе подписанный T1_… с row_id, мероприятием и типом билета.
+    """
+    if not event_code:
+        return str(row_id)  # НИКАКИХ ":" !
+    t = _TYPE_CODES.get((ticket_type or "").strip().lower(), "p")
+    body = f"{QR_PAYLOAD_VERSION}_{int(row_id)}_{_event_tag(event_code)}_{t}"
+    return f"{body}_{_sign(body)}"
+
+
+def parse_payload(raw: str, event_code: str | None):
     """
-    Генерирует PNG-байты QR-кода.
-    Полезная нагрузка: только row_id (только цифры) — подходит для ?start=<payload>.
+    Разбирает данные из QR/deep-link локально, без БД.
+    Возвращает (kind, number, ticket_type):
+      PAYLOAD_SIGNED      — number = row_id, ticket_type из подписи;
+      PAYLOAD_LEGACY      — number = user_id или row_id (старые QR: "<n>", "R:<n>", "QR:<n>", "<n>:…");
+      PAYLOAD_FORGED / PAYLOAD_OTHER_EVENT / PAYLOAD_INVALID — number = None.
     """
-    payload = str(row_id)  # НИКАКИХ ":" !
-    img = qrcode.make(payload)
+    p = (raw or "").strip()
+    if p.startswith(QR_PAYLOAD_VERSION + "_"):
+        parts = p.split("_")
+        if len(parts) != 5 or not parts[1].isdecimal() or parts[3] not in _TYPE_NAMES:
+            return PAYLOAD_INVALID, None, None
+        body, sig = "_".join(parts[:4]), parts[4]
+        if not hmac.compare_digest(sig.encode("utf-8"), _sign(body).encode("utf-8")):
+            return PAYLOAD_FORGED, None, None
+        if parts[2] != _event_tag(event_code or ""):
+            return PAYLOAD_OTHER_EVENT, None, None
+        return PAYLOAD_SIGNED, int(parts[1]), _TYPE_NAMES[parts[3]]
+
+    # Совместимый парсинг старых QR: убираем префиксы и «хвост» после двоеточия
+    if p.lower().startswith("qr:"):
+        p = p[3:].lstrip()
+    if p.lower().startswith("r:"):
+        p = p[2:].lstrip()
+    num_str = p.split(":", 1)[0]
+    try:
+        return PAYLOAD_LEGACY, int(num_str), None
+    except ValueError:
+        return PAYLOAD_INVALID, None, None
+
+
+# =========================
+# Кэш PNG: LRU в памяти + (опционально) файлы в QR_CACHE_DIR, ключ — payload
+# =========================
+_png_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+
+def _cache_path(payload: str) -> str | None:
+    if not QR_CACHE_DIR:
+        return None
+    return os.path.join(QR_CACHE_DIR, f"{payload}.{_PROFILE_TAG}.png")
+
+
+def is_qr_cached(row_id: int, event_code: str | None = None, ticket_type: str | None = None) -> bool:
+    """Есть ли готовый PNG этого билета (в памяти или на диске)."""
+    payload = make_payload(row_id, event_code, ticket_type)
+    if payload in _png_cache:
+        return True
+    path = _cache_path(payload)
+    return bool(path) and os.path.exists(path)
+
+
+def _read_file(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_file(path: str, data: bytes):
+    try:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[WARN] QR cache write failed: {e}")
+
+
+def _remember(payload: str, data: bytes):
+    _png_cache[payload] = data
+    _png_cache.move_to_end(payload)
+    while len(_png_cache) > QR_CACHE_SIZE:
+        _png_cache.popitem(last=False)
+
+
+# =========================
+# Профиль рендера: уровень коррекции, размер модуля, рамка, версия; PNG — 1 бит на пиксель
+# =========================
+_EC_LEVELS = {
+    "L": qrcode.constants.ERROR_CORRECT_L,
+    "M": qrcode.constants.ERROR_CORRECT_M,
+    "Q": qrcode.constants.ERROR_CORRECT_Q,
+    "H": qrcode.constants.ERROR_CORRECT_H,
+}
+# Тег профиля в имени файла кэша — после смены настроек не отдаём старые картинки
+_PROFILE_TAG = f"{QR_ERROR_CORRECTION}{QR_BOX_SIZE}b{QR_BORDER}v{QR_VERSION or 0}"
+
+
+def _render(payload: str, error_correction: str = QR_ERROR_CORRECTION, box_size: int = QR_BOX_SIZE,
+            border: int = QR_BORDER, version: int | None = QR_VERSION) -> bytes:
+    qr = qrcode.QRCode(
+        version=version,
+        error_correction=_EC_LEVELS.get(error_correction, qrcode.constants.ERROR_CORRECT_M),
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(payload)   # цифровой payload библиотека кодирует в numeric-режиме
+    try:
+        qr.make(fit=version is None)
+    except DataOverflowError:
+        # payload не влез в фиксированную версию — подбираем минимальную
+        qr.version = None
+        qr.make(fit=True)
+    img = qr.make_image().get_image().convert("1")
     buf = BytesIO()
-    img.save(buf, format="PNG")
+    img.save(buf, format="PNG", optimize=True)
     return buf.getvalue()
+
+
+def _render_timed(payload: str) -> tuple[bytes, float]:
+    # выполняется в воркере: время чистого рендера, без ожидания в очереди пула
+    t0 = time.perf_counter()
+    data = _render(payload)
+    return data, (time.perf_counter() - t0) * 1000
+
+
+# =========================
+# Пул рендера: CPU-работа qrcode/PIL не блокирует event loop.
+# В пуле одновременно не больше QR_RENDER_WORKERS задач, ждать слота могут ещё
+# QR_RENDER_QUEUE — сверх этого вызов сразу получает QrRenderBusy (сброс нагрузки).
+# Массовый пре-рендер (wait=True) сам ограничивает параллелизм и в лимит очереди не входит.
+# =========================
+class QrRenderBusy(RuntimeError):
+    """Очередь рендера QR заполнена — повторить позже."""
+
+
+_executor = None
+_slots: asyncio.Semaphore | None = None
+_sheddable = 0   # вызовы без wait=True: ждут слота + в пуле
+_render_stats = {
+    "rendered": 0,
+    "render_ms_total": 0.0,
+    "render_ms_max": 0.0,
+    "queue_depth": 0,       # ждут слота + в пуле сейчас
+    "queue_depth_max": 0,
+    "shed": 0,              # отказано: очередь заполнена
+}
+
+
+def _get_executor():
+    global _executor, _slots
+    if _executor is None:
+        workers = max(QR_RENDER_WORKERS, 1)
+        if QR_RENDER_MODE == "process":
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qr")
+        _slots = asyncio.Semaphore(workers)
+    return _executor
+
+
+async def _render_in_pool(payload: str, wait: bool = False) -> bytes:
+    global _sheddable
+    executor = _get_executor()
+    if not wait:
+        if _sheddable >= max(QR_RENDER_WORKERS, 1) + max(QR_RENDER_QUEUE, 0):
+            _render_stats["shed"] += 1
+            raise QrRenderBusy("QR render queue is full")
+        _sheddable += 1
+    _render_stats["queue_depth"] += 1
+    _render_stats["queue_depth_max"] = max(_render_stats["queue_depth_max"], _render_stats["queue_depth"])
+    try:
+        async with _slots:
+            data, ms = await asyncio.get_running_loop().run_in_executor(executor, _render_timed, payload)
+    finally:
+        _render_stats["queue_depth"] -= 1
+        if not wait:
+            _sheddable -= 1
+    _render_stats["rendered"] += 1
+    _render_stats["render_ms_total"] += ms
+    _render_stats["render_ms_max"] = max(_render_stats["render_ms_max"], ms)
+    return data
+
+
+def render_stats() -> dict:
+    """Метрики рендера (для /diag): сколько отрисовано, время, глубина очереди."""
+    n = _render_stats["rendered"]
+    return {
+        "mode": QR_RENDER_MODE,
+        "workers": QR_RENDER_WORKERS,
+        "rendered": n,
+        "render_ms_avg": round(_render_stats["render_ms_total"] / n, 2) if n else None,
+        "render_ms_max": round(_render_stats["render_ms_max"], 2),
+        "queue_depth": _render_stats["queue_depth"],
+        "queue_depth_max": _render_stats["queue_depth_max"],
+        "shed": _render_stats["shed"],
+        "cached": len(_png_cache),
+    }
+
+
+def shutdown_render_pool():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def generate_qr(row_id: int, event_code: str | None = None, ticket_type: str | None = None,
+                      remember: bool = True, wait: bool = False) -> bytes:
+    """
+    Генерирует PNG-байты QR-кода (с кэшем: память -> диск -> рендер в пуле).
+    Полезная нагрузка: подписанный T1_… (если передано мероприятие) или только row_id.
+    remember=False — не класть в LRU (массовый пре-рендер не вытесняет горячие билеты).
+    wait=True — при полной очереди ждать, а не падать с QrRenderBusy (для пакетных вызовов
+    с собственным ограничением параллелизма).
+    """
+    payload = make_payload(row_id, event_code, ticket_type)
+
+    data = _png_cache.get(payload)
+    if data is not None:
+        _png_cache.move_to_end(payload)
+        return data
+
+    path = _cache_path(payload)
+    if path:
+        data = await asyncio.to_thread(_read_file, path)
+    if data is None:
+        data = await _render_in_pool(payload, wait=wait)
+        if path:
+            await asyncio.to_thread(_write_file, path, data)
+
+    if remember:
+        _remember(payload, data)
+    return data
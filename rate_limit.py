@@ -0,0 +1,41 @@
+# rate_limit.py
+# Общий для процесса token bucket на исходящие сообщения в Telegram (~30 msg/s на бота).
+# Все массовые отправки (уведомления, рассылки) берут токен через acquire() —
+# сколько бы задач ни слали параллельно, суммарная скорость не выше TG_SEND_RATE.
+# pause() (по TelegramRetryAfter) останавливает выдачу токенов всем сразу.
+import asyncio
+import time
+
+from config import TG_SEND_RATE, TG_SEND_BURST
+
+_tokens = float(TG_SEND_BURST)
+_updated = time.monotonic()
+_lock: asyncio.Lock | None = None
+_paused_until = 0.0
+
+
+def pause(seconds: float):
+    """Telegram попросил подождать — не выдаём токены seconds секунд (всем отправителям)."""
+    global _paused_until, _tokens
+    _paused_until = max(_paused_until, time.monotonic() + float(seconds))
+    _tokens = 0.0
+
+
+async def acquire():
+    """Дождаться токена на одну отправку."""
+    global _tokens, _updated, _lock
+    if _lock is None:
+        _lock = asyncio.Lock()
+    async with _lock:   # очередь FIFO: токены раздаются по порядку запросов
+        while True:
+            now = time.monotonic()
+            if now < _paused_until:
+                await asyncio.sleep(_paused_until - now)
+                _updated = time.monotonic()
+                continue
+            _tokens = min(float(TG_SEND_BURST), _tokens + (now - _updated) * TG_SEND_RATE)
+            _updated = now
+            if _tokens >= 1:
+                _tokens -= 1
+                return
+            await asyncio.sleep((1 - _tokens) / TG_SEND_RATE)
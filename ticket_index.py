@@ -0,0 +1,139 @@
+# ticket_index.py
+# In-memory индекс билетов текущего мероприятия для прохода на входе.
+# row_id -> (ticket_type, активирован?, user_id) + карта старых QR user_id -> row_id.
+# Индекс — только ускоритель: «уже использован» по известным билетам отвечаем без БД,
+# в БД уходит только выигравшая запись активации. Промах (билет оплачен в другом месте/
+# другим инстансом, другое мероприятие, неизвестный номер) — решает БД (checkin_ticket).
+import sys
+
+from database import (
+    get_event_tickets, get_legacy_qr_map_for_event, activate_ticket_by_id, checkin_ticket,
+    activate_tickets_by_ids, checkin_tickets_batch,
+    CHECKIN_ACTIVATED, CHECKIN_ALREADY_USED,
+)
+
+_event_code: str | None = None
+_loaded = False
+_rows: dict[int, tuple[str, bool, int]] = {}   # row_id -> (ticket_type, activated, user_id)
+_legacy_map: dict[int, int] = {}             # user_id -> row_id (старые QR, из legacy_qr_map)
+
+
+def _event_off(event_code: str | None) -> bool:
+    return not event_code or event_code.strip().lower() == "none"
+
+
+def clear():
+    global _event_code, _loaded
+    _event_code = None
+    _loaded = False
+    _rows.clear()
+    _legacy_map.clear()
+
+
+def add(row_id: int, user_id: int, ticket_type: str | None, status: str | None, event_code: str | None = None):
+    """Добавить/обновить билет в индексе (вызывать после подтверждения оплаты)."""
+    if not _loaded or (event_code is not None and event_code != _event_code):
+        return
+    _rows[int(row_id)] = (sys.intern(ticket_type or "-"), status == "активирован", int(user_id))
+
+
+def remove(row_id: int):
+    """Убрать билет из индекса (оплата отклонена / снята) — дальше решает БД."""
+    _rows.pop(int(row_id), None)
+
+
+def _resolve(candidate: int, legacy: bool) -> int | None:
+    # Сначала row_id; старый QR (user_id) — только если такого билета нет
+    if candidate in _rows or not legacy:
+        return candidate
+    return _legacy_map.get(candidate)
+
+
+async def load(event_code: str | None):
+    """Загрузить индекс для мероприятия (на старте и при смене события)."""
+    global _event_code, _loaded
+    clear()
+    if _event_off(event_code):
+        return
+    rows = await get_event_tickets(event_code)
+    _event_code = event_code
+    _loaded = True
+    for r in rows:
+        add(r["id"], r["user_id"], r["ticket_type"], r["status"])
+    for r in await get_legacy_qr_map_for_event(event_code):
+        _legacy_map[int(r["user_id"])] = int(r["row_id"])
+    print(f"[INDEX] Loaded {len(_rows)} tickets for '{event_code}'", flush=True)
+
+
+async def checkin(candidate: int, legacy: bool = True):
+    """
+    Проход по числу из QR. Порядок разрешения как в checkin_ticket:
+    сначала row_id, при legacy=True — затем старый QR через legacy_qr_map.
+    Если индекс не загружен или билета в нём нет — идём в БД напрямую.
+    Возвращает (CHECKIN_*, {"id", "ticket_type"} | None).
+    """
+    row_id = _resolve(candidate, legacy) if _loaded else None
+    item = _rows.get(row_id)
+    if item is None:
+        return await checkin_ticket(candidate, legacy=legacy)
+
+    ticket_type, activated, user_id = item
+    row = {"id": row_id, "ticket_type": ticket_type}
+    if activated:
+        return CHECKIN_ALREADY_USED, row
+
+    # занимаем билет в памяти ДО await — параллельный скан увидит «уже использован»
+    _rows[row_id] = (ticket_type, True, user_id)
+    try:
+        won = await activate_ticket_by_id(row_id)
+    except Exception:
+        _rows[row_id] = (ticket_type, False, user_id)
+        raise
+    return (CHECKIN_ACTIVATED if won else CHECKIN_ALREADY_USED), row
+
+
+async def checkin_many(items: list[tuple[int, bool]]):
+    """
+    Пакетный проход: items — [(candidate, legacy), ...].
+    Из индекса отвечаем сразу, все победившие активации уходят в БД одним UPDATE.
+    Промахи индекса (или весь пакет без индекса) — один пакетный запрос checkin_tickets_batch.
+    """
+    if not _loaded:
+        return await checkin_tickets_batch(items)
+
+    out = []
+    misses: list[int] = []                     # позиции в out, которые решает БД
+    claimed: dict[int, tuple[str, int]] = {}   # row_id -> (ticket_type, user_id)
+    for candidate, legacy in items:
+        row_id = _resolve(candidate, legacy)
+        item = _rows.get(row_id)
+        if item is None:
+            misses.append(len(out))
+            out.append(None)
+            continue
+        ticket_type, activated, user_id = item
+        row = {"id": row_id, "ticket_type": ticket_type}
+        if activated:
+            out.append((CHECKIN_ALREADY_USED, row))
+            continue
+        _rows[row_id] = (ticket_type, True, user_id)
+        claimed[row_id] = (ticket_type, user_id)
+        out.append((CHECKIN_ACTIVATED, row))
+
+    try:
+        won = await activate_tickets_by_ids(list(claimed))
+    except Exception:
+        for row_id, (ticket_type, user_id) in claimed.items():
+            _rows[row_id] = (ticket_type, False, user_id)
+        raise
+
+    # активировано другим процессом раньше нас — «уже использован»
+    out = [
+        (CHECKIN_ALREADY_USED, res[1])
+        if res is not None and res[0] == CHECKIN_ACTIVATED and res[1]["id"] not in won else res
+        for res in out
+    ]
+    if misses:
+        for i, res in zip(misses, await checkin_tickets_batch([items[i] for i in misses])):
+            out[i] = res
+    return out